@@ -0,0 +1,91 @@
+import os
+import sqlite3
+from collections import Counter
+from typing import Dict, Optional, Union
+
+
+# Session names of telegram accounts in the pool, first one is the default account
+ACCOUNTS = [name.strip() for name in os.getenv('TELEGRAM_ACCOUNTS', 'account').split(',') if name.strip()]
+# SQLite file which keeps owning account of every group
+ACCOUNTS_DB = os.getenv('ACCOUNTS_DB', 'accounts.db')
+
+# chat id -> owning account, loaded from database on first use
+_owners: Optional[Dict[int, str]] = None
+_conn: Optional[sqlite3.Connection] = None
+# Calls running right now per account, used to break ties between accounts
+_in_flight = Counter()
+
+
+def _db() -> sqlite3.Connection:
+    global _conn
+
+    if _conn is None:
+        _conn = sqlite3.connect(ACCOUNTS_DB, check_same_thread=False)
+        _conn.execute('CREATE TABLE IF NOT EXISTS owners (chat_id INTEGER PRIMARY KEY, account TEXT NOT NULL)')
+        _conn.commit()
+
+    return _conn
+
+
+def _load() -> Dict[int, str]:
+    global _owners
+
+    if _owners is None:
+        _owners = {chat_id: name for chat_id, name in _db().execute('SELECT chat_id, account FROM owners')}
+
+    return _owners
+
+
+# Return default account
+def default() -> str:
+    return ACCOUNTS[0]
+
+
+# Return account which owns given chat, None if chat is unknown or owner is not in the pool anymore
+def owner(chat_id: Optional[Union[int, str]]) -> Optional[str]:
+    if chat_id is None:
+        return None
+
+    try:
+        name = _load().get(int(chat_id))
+    except ValueError:
+        return None
+
+    return name if name in ACCOUNTS else None
+
+
+# Store owning account of a chat
+def assign(chat_id: Union[int, str], name: str):
+    chat_id = int(chat_id)
+    if _load().get(chat_id) == name:
+        return
+
+    _owners[chat_id] = name
+    _db().execute('INSERT OR REPLACE INTO owners (chat_id, account) VALUES (?, ?)', (chat_id, name))
+    _db().commit()
+
+
+# Store owner of chats which have none yet, used when learning groups from dialogs
+# All new owners are written in one transaction, so scans of big accounts do not commit once per group
+def learn(chat_ids: list, name: str):
+    new = [(int(chat_id), name) for chat_id in chat_ids if owner(chat_id) is None]
+    if not new:
+        return
+
+    _load().update(new)
+    _db().executemany('INSERT OR REPLACE INTO owners (chat_id, account) VALUES (?, ?)', new)
+    _db().commit()
+
+
+# Return account with fewest owned groups, then fewest running calls
+def least_loaded() -> str:
+    groups = Counter(_load().values())
+    return min(ACCOUNTS, key=lambda name: (groups[name], _in_flight[name]))
+
+
+def started(name: str):
+    _in_flight[name] += 1
+
+
+def finished(name: str):
+    _in_flight[name] -= 1
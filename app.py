@@ -1,6 +1,10 @@
-from flask import Flask
+import time
+from quart import Quart, Response, g, request
+from idempotency import idempotent
 import telegram
-from controllers import groups, message
+import jobs
+import metrics
+from controllers import batch, contacts, groups, jobs as jobs_controller, message
 from middlewares.auth import AuthMiddleware
 from logging.config import dictConfig
 
@@ -10,78 +14,155 @@ dictConfig({
     'formatters': {'default': {
         'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
     }},
-    'handlers': {'wsgi': {
+    'handlers': {'default': {
         'class': 'logging.StreamHandler',
         'formatter': 'default'
     }},
     'root': {
         'level': 'DEBUG',
-        'handlers': ['wsgi']
+        'handlers': ['default']
     }
 })
 
-# Create flask instance
-app = Flask(__name__)
+# Create quart instance
+app = Quart(__name__)
 
 # Call auth middleware to check service key
-app.wsgi_app = AuthMiddleware(app.wsgi_app)
+app.asgi_app = AuthMiddleware(app.asgi_app)
+
+
+# Start telegram clients of all accounts once the event loop is running
+@app.before_serving
+async def startup():
+    await telegram.get_clients()
+    await jobs.start()
+
+
+# Disconnect telegram clients on shutdown
+@app.after_serving
+async def shutdown():
+    await jobs.stop()
+    await telegram.stop_client()
+
+
+# Record latency of every request
+@app.before_request
+async def start_timer():
+    g.started_at = time.perf_counter()
+
+
+@app.after_request
+async def record_latency(response):
+    route = request.url_rule.rule if request.url_rule else 'unknown'
+    metrics.request_duration.observe(
+        time.perf_counter() - g.started_at, route=route, method=request.method, status=response.status_code
+    )
+    return response
 
 
 # Define routes
 
 # Create telegram group with given title and description
 @app.route('/group/create', methods=['POST'])
+@idempotent
 async def create_group():
     return await groups.create()
 
 
 # Delete an existing group with given chat_id
 @app.route('/group/delete', methods=['POST'])
+@idempotent
 async def delete_group():
     return await groups.archive()
 
 
 # Unarchive an existing group with given chat_id
 @app.route('/group/unarchive', methods=['POST'])
+@idempotent
 async def uanrchive_group():
     return await groups.unarchive()
 
 
 # Add members to an existing group
 @app.route('/group/members/add', methods=['POST'])
+@idempotent
 async def add_chat_members():
     return await groups.add_chat_members()
 
 
 # Ban members from an existing group
 @app.route('/group/members/ban', methods=['POST'])
+@idempotent
 async def ban_chat_member():
     return await groups.ban_chat_member()
 
 
+# Unban members of an existing group
+@app.route('/group/members/unban', methods=['POST'])
+@idempotent
+async def unban_chat_member():
+    return await groups.unban_chat_member()
+
+
+# Ban a user from every group it is in
+@app.route('/members/ban-everywhere', methods=['POST'])
+@idempotent
+async def ban_everywhere():
+    return await groups.ban_everywhere()
+
+
+# Unban a user in every group
+@app.route('/members/unban-everywhere', methods=['POST'])
+@idempotent
+async def unban_everywhere():
+    return await groups.unban_everywhere()
+
+
 @app.route('/groups', methods=['GET'])
 async def sync_groups():
     return await groups.sync_groups()
 
 
 @app.route('/message/delete', methods=['POST'])
+@idempotent
 async def delete_message():
     return await message.delete()
 
 
 @app.route('/message/edit', methods=['POST'])
+@idempotent
 async def edit_message():
     return await message.edit()
 
 
 @app.route('/message/send', methods=['POST'])
+@idempotent
 async def send_message():
     return await message.send()
 
 
+# Run many message and member operations in one request
+@app.route('/batch', methods=['POST'])
+@idempotent
+async def run_batch():
+    return await batch.run()
+
+
 @app.route('/contacts/sync', methods=['GET'])
 async def sync_contacts():
-    return await telegram.get_contacts()
+    return await contacts.sync()
+
+
+# Get status, progress and result of a background job
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def show_job(job_id):
+    return await jobs_controller.show(job_id)
+
+
+# Expose service metrics in prometheus text format
+@app.route('/metrics', methods=['GET'])
+async def show_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
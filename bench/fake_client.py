@@ -0,0 +1,221 @@
+import asyncio
+import itertools
+import random
+from types import SimpleNamespace
+from typing import List, Union
+from pyrogram import raw, types
+from pyrogram.enums import ChatMemberStatus, ChatType
+from pyrogram.errors import FloodWait
+
+
+# In process stand in for pyrogram Client with configurable latency, FloodWait injection and fixtures
+# Only the methods used by telegram.py are implemented
+
+# Ids are shared by all fake clients, so chats of different accounts never collide
+_ids = itertools.count(1)
+
+
+class FakeStorage:
+    def __init__(self):
+        self.peers = {}
+
+    async def get_peer_by_id(self, peer_id: int):
+        if peer_id not in self.peers:
+            raise KeyError(peer_id)
+        return self.peers[peer_id]
+
+    async def update_peers(self, peers: List[tuple]):
+        for peer in peers:
+            self.peers[peer[0]] = peer
+
+
+class FakeMessage:
+    def __init__(self, client: 'FakeClient', chat_id: int, message_id: int):
+        self._client = client
+        self.id = message_id
+        self.chat = SimpleNamespace(id=chat_id)
+
+    async def pin(self, disable_notification: bool = False):
+        await self._client.rpc()
+        return True
+
+
+class FakeClient:
+    def __init__(self, name: str = 'account', latency: float = 0.05, jitter: float = 0.5, flood_rate: float = 0.0,
+                 flood_seconds: int = 1, groups: int = 100, members: int = 200, contacts: int = 100,
+                 admin_links: int = 10):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.members = members
+        self.admin_links = admin_links
+        self.is_connected = False
+        self.storage = FakeStorage()
+        self.calls = 0
+        self.floods = 0
+
+        self.chats = {}
+        for _ in range(groups):
+            self._add_chat(f'Fixture group {len(self.chats)}', 'fixture')
+        self.contacts = [
+            SimpleNamespace(
+                id=1000000 + index, first_name=f'Contact {index}', last_name=None,
+                username=f'contact{index}', phone_number=f'98900000{index:04d}'
+            )
+            for index in range(contacts)
+        ]
+
+    def _add_chat(self, title: str, description: str) -> types.Chat:
+        chat_id = -1001000000000 - next(_ids)
+        chat = types.Chat(id=chat_id, type=ChatType.SUPERGROUP, title=title, description=description)
+        self.chats[chat_id] = chat
+        return chat
+
+    # Simulate one round trip to telegram
+    async def rpc(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.floods += 1
+            raise FloodWait(value=self.flood_seconds)
+
+    async def start(self):
+        await self.rpc()
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+    def add_handler(self, handler, group: int = 0):
+        pass
+
+    async def invoke(self, query):
+        await self.rpc()
+        if isinstance(query, raw.functions.messages.GetCommonChats):
+            return self._common_chats(query)
+        return True
+
+    # Every fixture group is shared with every user, paged by raw channel id like telegram does
+    def _common_chats(self, query) -> raw.types.messages.Chats:
+        channels = sorted(
+            (
+                raw.types.Channel(
+                    id=-chat_id - 1000000000000, title=chat.title, photo=raw.types.ChatPhotoEmpty(), date=0,
+                    megagroup=True
+                )
+                for chat_id, chat in self.chats.items()
+            ),
+            key=lambda channel: channel.id, reverse=True
+        )
+        if query.max_id:
+            channels = [channel for channel in channels if channel.id < query.max_id]
+
+        return raw.types.messages.Chats(chats=channels[:query.limit])
+
+    async def get_me(self):
+        await self.rpc()
+        return SimpleNamespace(id=1, username='account')
+
+    async def resolve_peer(self, peer_id: Union[int, str]):
+        await self.rpc()
+        user_id = peer_id if isinstance(peer_id, int) else 2000000 + abs(hash(peer_id)) % 1000000
+        await self.storage.update_peers([(user_id, user_id * 7, 'user', str(peer_id), None)])
+        return raw.types.InputPeerUser(user_id=user_id, access_hash=user_id * 7)
+
+    async def create_supergroup(self, title: str, description: str = ''):
+        await self.rpc()
+        return self._add_chat(title, description)
+
+    async def get_chat(self, chat_id: int):
+        await self.rpc()
+        return self.chats[chat_id]
+
+    async def send_message(self, chat_id: int, text: str, parse_mode=None):
+        await self.rpc()
+        return FakeMessage(self, chat_id, next(_ids))
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs):
+        await self.rpc()
+        return FakeMessage(self, chat_id, message_id)
+
+    async def delete_messages(self, chat_id: int, message_ids, revoke: bool = True):
+        await self.rpc()
+        return len(message_ids) if isinstance(message_ids, list) else 1
+
+    async def set_chat_permissions(self, chat_id: int, permissions):
+        await self.rpc()
+        return self.chats.get(chat_id)
+
+    async def create_chat_invite_link(self, chat_id: int, **kwargs):
+        await self.rpc()
+        return SimpleNamespace(invite_link=f'https://t.me/+fake{next(_ids)}', is_revoked=False)
+
+    async def add_chat_members(self, chat_id: int, user_ids, forward_limit: int = 100):
+        await self.rpc()
+        return True
+
+    async def promote_chat_member(self, chat_id: int, user_id: int, privileges=None):
+        await self.rpc()
+        return True
+
+    async def ban_chat_member(self, chat_id: int, user_id: int, until_date=None):
+        await self.rpc()
+        return True
+
+    async def unban_chat_member(self, chat_id: int, user_id: int):
+        await self.rpc()
+        return True
+
+    async def restrict_chat_member(self, chat_id: int, user_id: int, permissions, until_date=None):
+        await self.rpc()
+        return self.chats.get(chat_id)
+
+    async def archive_chats(self, chat_ids: list):
+        await self.rpc()
+        return True
+
+    async def unarchive_chats(self, chat_ids: list):
+        await self.rpc()
+        return True
+
+    async def get_contacts(self):
+        await self.rpc()
+        return list(self.contacts)
+
+    async def revoke_chat_invite_link(self, chat_id: int, invite_link: str):
+        await self.rpc()
+        return SimpleNamespace(invite_link=invite_link, is_revoked=True)
+
+    async def delete_chat_admin_invite_links(self, chat_id: int, admin_id: int):
+        await self.rpc()
+        return True
+
+    # Async iterators page through fixtures 100 items per round trip like pyrogram does
+    async def _paged(self, items: list):
+        for index, item in enumerate(items):
+            if index % 100 == 0:
+                await self.rpc()
+            yield item
+
+    def get_dialogs(self, limit: int = 0):
+        return self._paged([SimpleNamespace(chat=chat) for chat in self.chats.values()])
+
+    def get_chat_members(self, chat_id: int, **kwargs):
+        owner = SimpleNamespace(status=ChatMemberStatus.OWNER, user=SimpleNamespace(id=1))
+        members = [
+            SimpleNamespace(status=ChatMemberStatus.MEMBER, user=SimpleNamespace(id=3000000 + index))
+            for index in range(self.members)
+        ]
+        return self._paged([owner] + members)
+
+    def get_chat_admin_invite_links(self, chat_id: int, admin_id: int, revoked: bool = False, **kwargs):
+        links = [
+            SimpleNamespace(
+                invite_link=f'https://t.me/+link{index}', is_revoked=revoked, is_primary=index == 0,
+                expire_date=None, member_limit=None
+            )
+            for index in range(self.admin_links)
+        ]
+        return self._paged(links)
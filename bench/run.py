@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+
+# Offline benchmark of service routes against an in process fake telegram client
+# Usage: python -m bench.run [--scenario create] [--requests 50] [--concurrency 10] [--json]
+
+API_KEY = 'bench'
+
+SCENARIOS = ('create', 'send', 'archive', 'groups', 'groups_scan')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark service routes with a fake telegram client')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenario to run, default all')
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests running at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake rpc')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='probability of FloodWait per rpc')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='FloodWait value')
+    parser.add_argument('--accounts', type=int, default=1, help='telegram accounts in the pool')
+    parser.add_argument('--groups', type=int, default=500, help='groups of every account')
+    parser.add_argument('--members', type=int, default=2000, help='members of every group')
+    parser.add_argument('--fanout', type=int, default=100, help='chats per send request')
+    parser.add_argument('--real-limits', action='store_true', help='keep configured rate limits')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    return parser.parse_args()
+
+
+# Call ASGI app (with middlewares) like a server would and return status and body
+async def call(app, method: str, url: str, body: dict = None) -> (int, bytes):
+    status, _, content = await request(app, method, url, body)
+    return status, content
+
+
+# Call ASGI app with extra request headers and return status, response headers and body
+async def request(app, method: str, url: str, body: dict = None, headers: dict = None) -> (int, dict, bytes):
+    url = urlsplit(url)
+    payload = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': url.path,
+        'raw_path': url.path.encode(),
+        'query_string': url.query.encode(),
+        'root_path': '',
+        'headers': [
+            (b'host', b'bench'),
+            (b'authorization', API_KEY.encode()),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+        ] + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        'client': ('127.0.0.1', 0),
+        'server': ('bench', 80),
+    }
+
+    received = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': payload, 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    status = 0
+    response_headers = {}
+    chunks = []
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            response_headers.update((name.decode().lower(), value.decode()) for name, value in message['headers'])
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    try:
+        await app.asgi_app(scope, receive, send)
+    finally:
+        disconnected.set()
+
+    return status, response_headers, b''.join(chunks)
+
+
+# Check if a response reports a failure anywhere in its body
+# Routes answer 200 with failed members, steps, groups or items inside data, so those count as errors too
+def failed(content: bytes) -> bool:
+    try:
+        return _failed(json.loads(content))
+    except ValueError:
+        return True
+
+
+def _failed(body) -> bool:
+    if isinstance(body, list):
+        return any(_failed(item) for item in body)
+    if not isinstance(body, dict):
+        return False
+
+    status = body.get('status')
+    if isinstance(status, int) and status >= 400:
+        return True
+    if body.get('failed_members') or body.get('skipped_groups'):
+        return True
+    if isinstance(body.get('promoted_admins'), dict) and not all(body['promoted_admins'].values()):
+        return True
+    if any(body.get(key) is False for key in ('ok', 'deleted', 'edited')):
+        return True
+
+    return any(_failed(value) for value in body.values())
+
+
+def percentile(values: list, rank: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+# Run requests built by make_request with bounded concurrency and collect latencies
+async def load(app, make_request, total: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(index: int):
+        nonlocal errors
+        method, url, body = make_request(index)
+        async with semaphore:
+            start = time.perf_counter()
+            status, content = await call(app, method, url, body)
+            latencies.append(time.perf_counter() - start)
+        if status >= 400 or failed(content):
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(total)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'throughput_rps': round(total / elapsed, 2),
+    }
+
+
+async def main(args: argparse.Namespace) -> dict:
+    import accounts
+    import app as service
+    import helpers
+    import telegram
+    from bench.fake_client import FakeClient
+
+    fakes = {
+        name: FakeClient(
+            name=name, latency=args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds,
+            groups=args.groups, members=args.members
+        )
+        for name in accounts.ACCOUNTS
+    }
+
+    # Serve every telegram call from fake clients and keep alerts offline
+    async def get_client(chat_id=None, account=None):
+        fake = fakes[account or accounts.owner(chat_id) or accounts.default()]
+        if not fake.is_connected:
+            await fake.start()
+        return fake
+
+    telegram.get_client = get_client
+    helpers._post_alert = lambda message: None
+
+    chat_ids = []
+    for name, fake in fakes.items():
+        for chat_id in fake.chats:
+            accounts.assign(chat_id, name)
+            chat_ids.append(chat_id)
+
+    scenarios = {
+        'create': lambda i: ('POST', '/group/create', {
+            'title': f'Bench group {i}', 'description': 'bench', 'welcome_text': 'welcome', 'pin': True,
+        }),
+        'send': lambda i: ('POST', '/message/send', {
+            'chat_ids': chat_ids[:args.fanout], 'message': f'announcement {i}', 'pin': True,
+        }),
+        'archive': lambda i: ('POST', '/group/delete', {'id': chat_ids[i % len(chat_ids)]}),
+        'groups': lambda i: ('GET', '/groups', None),
+        'groups_scan': lambda i: ('GET', '/groups', None),
+    }
+
+    await service.app.startup()
+    results = {}
+    try:
+        for name in args.scenario or SCENARIOS:
+            # Rebuild index on every request to measure a full dialogs scan
+            telegram.DIRECTORY_RESYNC_INTERVAL = 0 if name == 'groups_scan' else 3600
+            if name == 'groups':
+                await telegram.get_all_groups()
+
+            calls = sum(fake.calls for fake in fakes.values())
+            floods = sum(fake.floods for fake in fakes.values())
+            results[name] = await load(service.app, scenarios[name], args.requests, args.concurrency)
+            results[name]['rpc_calls'] = sum(fake.calls for fake in fakes.values()) - calls
+            results[name]['flood_waits'] = sum(fake.floods for fake in fakes.values()) - floods
+    finally:
+        await service.app.shutdown()
+
+    return results
+
+
+def report(results: dict):
+    columns = ('requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'rpc_calls', 'flood_waits')
+    print(f'{"scenario":<12}' + ''.join(f'{column:>16}' for column in columns))
+    for name, result in results.items():
+        print(f'{name:<12}' + ''.join(f'{result[column]:>16}' for column in columns))
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+
+    # Service reads its settings at import time, so set them before importing it
+    os.environ['API_KEY'] = API_KEY
+    os.environ.setdefault('TELEGRAM_BOT_USERNAME', 'bench_bot')
+    os.environ.setdefault('JOBS_DB', os.path.join(tempfile.mkdtemp(), 'jobs.db'))
+    os.environ.setdefault('ACCOUNTS_DB', os.path.join(tempfile.mkdtemp(), 'accounts.db'))
+    os.environ['TELEGRAM_ACCOUNTS'] = ','.join(f'bench{index}' for index in range(arguments.accounts))
+    if not arguments.real_limits:
+        for kind in ('MESSAGES', 'MEMBERS', 'ADMIN', 'READ', 'CHAT'):
+            os.environ.setdefault(f'RATE_LIMIT_{kind}', '100000:100000')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = asyncio.run(main(arguments))
+
+    if arguments.json:
+        print(json.dumps(output, indent=2))
+    else:
+        report(output)
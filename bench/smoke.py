@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+
+# Run core telegram calls and routes once against the fake client and exit with status 1 if any of them fails
+# Usage: python -m bench.smoke
+
+
+async def main() -> list:
+    import app as service
+    import helpers
+    import telegram
+    from bench.fake_client import FakeClient
+    from bench.run import call, failed, request
+
+    fake = FakeClient(latency=0, groups=2, members=5)
+
+    async def get_client(chat_id=None, account=None):
+        if not fake.is_connected:
+            await fake.start()
+        return fake
+
+    telegram.get_client = get_client
+    helpers._post_alert = lambda message: None
+    chat_id, other_chat_id = list(fake.chats)
+
+    # name -> coroutine function which returns true when the call worked
+    checks = {
+        'edit_message': lambda: _ok(telegram.edit_message(1, chat_id, 'edited')),
+        'delete_message': lambda: _ok(telegram.delete_message(1, chat_id)),
+        'delete_messages_bulk': lambda: _all_ok(telegram.delete_messages_bulk([(chat_id, i) for i in range(150)])),
+        'edit_messages': lambda: _all_ok(telegram.edit_messages([(chat_id, 1, 'edited'), (chat_id, 2, 'edited')])),
+        'promote_member': lambda: telegram.promote_member(chat_id, 3000000),
+        'restrict_members': lambda: _ok(telegram.change_all_chat_members_permissions(fake, chat_id, chat_wide=False)),
+    }
+
+    # Same paths through the routes, a response fails like it does in bench
+    routes = {
+        'POST /message/edit': {'chat_id': chat_id, 'message_id': 1, 'message': 'edited'},
+        'POST /message/delete': {'chat_id': chat_id, 'message_id': 1},
+        'POST /message/delete messages': {'messages': [{'chat_id': chat_id, 'message_id': 2}]},
+        'POST /message/send': {'chat_ids': [chat_id, other_chat_id], 'message': 'hello', 'timeout': 5},
+        'POST /batch': {'operations': [
+            {'op': 'message.delete', 'chat_id': chat_id, 'message_id': 3},
+            {'op': 'message.delete', 'chat_id': chat_id, 'message_id': 4},
+            {'op': 'message.edit', 'chat_id': other_chat_id, 'message_id': 5, 'message': 'edited'},
+            {'op': 'group.members.ban', 'chat_id': other_chat_id, 'user_id': 3000001},
+            {'op': 'group.members.unban', 'chat_id': other_chat_id, 'user_id': 3000001},
+        ]},
+        'POST /members/ban-everywhere': {'user_id': 3000002},
+        'POST /group/members/add': {'chat_id': chat_id, 'user_ids': ['alice'], 'admins': ['alice']},
+        'POST /group/create': {'title': 'Smoke group', 'description': 'smoke', 'welcome_text': 'welcome', 'pin': True},
+        'GET /contacts/sync': None,
+        'GET /groups': None,
+    }
+    for name, body in routes.items():
+        method, url = name.split()[:2]
+        checks[name] = lambda method=method, url=url, body=body: _route_ok(call(service.app, method, url, body), failed)
+
+    # Invalid input must be answered with 422 before anything is sent to telegram
+    invalid = {
+        'POST /message/send timeout': {'chat_ids': [chat_id], 'message': 'hello', 'timeout': '5'},
+        'POST /message/delete message_id': {'messages': [{'chat_id': chat_id, 'message_id': 'abc'}]},
+        'POST /batch message_id': {'operations': [{'op': 'message.delete', 'chat_id': chat_id, 'message_id': 'abc'}]},
+        'POST /members/ban-everywhere user_id': {},
+        'GET /groups?stream=1&since=0 since': None,
+        'GET /contacts/sync?stream=1&since=0 since': None,
+    }
+    for name, body in invalid.items():
+        method, url = name.split()[:2]
+        checks[name] = lambda method=method, url=url, body=body: _route_rejected(call(service.app, method, url, body))
+
+    checks['GET /contacts/sync etag and since'] = lambda: _contacts_synced(service.app, request)
+    checks['GET /groups?since='] = lambda: _groups_synced(service.app, request)
+    checks['POST /message/send idempotency'] = lambda: _replayed(service.app, request, fake, chat_id)
+
+    # Deleting a group goes last, the checks above use both chats
+    checks['POST /group/delete'] = lambda: _route_ok(
+        call(service.app, 'POST', '/group/delete', {'id': other_chat_id}), failed
+    )
+
+    await service.app.startup()
+    failures = []
+    try:
+        for name, check in checks.items():
+            try:
+                ok = await check()
+            except Exception as e:
+                ok = False
+                print(f'{name}: {type(e).__name__}: {e}')
+            print(f'{"ok" if ok else "FAILED":<8}{name}')
+            if not ok:
+                failures.append(name)
+    finally:
+        await service.app.shutdown()
+
+    return failures
+
+
+async def _ok(call) -> bool:
+    result = await call
+    return result[0] is True
+
+
+async def _all_ok(call) -> bool:
+    return all(res is True for res, _ in await call)
+
+
+async def _route_ok(call, failed) -> bool:
+    status, content = await call
+    if status >= 400 or failed(content):
+        print(content.decode())
+        return False
+    return True
+
+
+# Check that a route answered 422, at top level or for every item of a batch
+async def _route_rejected(call) -> bool:
+    status, content = await call
+    body = json.loads(content)
+    items = body.get('data') if body.get('status') == 200 else None
+    if status == 422 or body.get('status') == 422 or (items and all(item.get('status') == 422 for item in items)):
+        return True
+
+    print(content.decode())
+    return False
+
+
+# Contacts answer 304 for the ETag they sent and a delta for their version
+async def _contacts_synced(app, request) -> bool:
+    status, headers, _ = await request(app, 'GET', '/contacts/sync')
+    etag = headers.get('etag')
+    if status != 200 or not etag:
+        return False
+
+    status, _, _ = await request(app, 'GET', '/contacts/sync', headers={'If-None-Match': etag})
+    if status != 304:
+        print(f'If-None-Match answered {status}')
+        return False
+
+    status, _, content = await request(app, 'GET', f'/contacts/sync?since={etag.strip(chr(34))}')
+    delta = json.loads(content)
+    return status == 200 and delta.get('full') is False
+
+
+# Groups changed since a cursor are a partial list
+async def _groups_synced(app, request) -> bool:
+    _, _, content = await request(app, 'GET', '/groups')
+    cursor = json.loads(content)['cursor']
+
+    _, _, content = await request(app, 'GET', f'/groups?since={cursor}')
+    body = json.loads(content)
+    return body.get('status') == 200 and body.get('full') is False
+
+
+# A request sent again with the same Idempotency-Key is replayed without sending anything
+async def _replayed(app, request, fake, chat_id) -> bool:
+    sent = []
+    send_message = fake.send_message
+
+    async def counted(*args, **kwargs):
+        sent.append(args)
+        return await send_message(*args, **kwargs)
+
+    fake.send_message = counted
+    try:
+        body = {'chat_ids': [chat_id], 'message': 'once'}
+        key = {'Idempotency-Key': 'smoke'}
+        _, _, first = await request(app, 'POST', '/message/send', body, key)
+        _, headers, second = await request(app, 'POST', '/message/send', body, key)
+        _, _, other = await request(app, 'POST', '/message/send', {**body, 'message': 'other'}, key)
+    finally:
+        fake.send_message = send_message
+
+    if len(sent) != 1 or first != second or headers.get('idempotent-replayed') != 'true':
+        print(f'sent {len(sent)} times, replayed {headers.get("idempotent-replayed")}')
+        return False
+
+    # Same key with another payload is rejected
+    return json.loads(other).get('status') == 422
+
+
+if __name__ == '__main__':
+    # Service reads its settings at import time, so set them before importing it
+    os.environ['API_KEY'] = 'bench'
+    os.environ.setdefault('TELEGRAM_BOT_USERNAME', 'bench_bot')
+    os.environ.setdefault('JOBS_DB', os.path.join(tempfile.mkdtemp(), 'jobs.db'))
+    os.environ.setdefault('ACCOUNTS_DB', os.path.join(tempfile.mkdtemp(), 'accounts.db'))
+    for kind in ('MESSAGES', 'MEMBERS', 'ADMIN', 'READ', 'CHAT'):
+        os.environ.setdefault(f'RATE_LIMIT_{kind}', '100000:100000')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit(1 if asyncio.run(main()) else 0)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+from pyrogram import Client, raw
+
+
+# Seconds a fetched contacts list is served from cache
+CONTACTS_TTL = int(os.getenv('CONTACTS_TTL', '300'))
+# Number of previous versions kept to answer delta requests
+CONTACTS_HISTORY = int(os.getenv('CONTACTS_HISTORY', '20'))
+
+_contacts: Optional[list] = None
+_version: Optional[str] = None
+_fetched_at = 0.0
+
+# version -> {contact id: contact fingerprint}
+_snapshots = OrderedDict()
+
+# Updates which mean a contact has been added, removed or changed
+_INVALIDATING_UPDATES = (
+    raw.types.UpdateUserName,
+    raw.types.UpdateUserPhone,
+    raw.types.UpdatePeerSettings,
+)
+
+
+def _fingerprint(data) -> str:
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# Return cached contacts list and its version, or None if cache is empty or expired
+def get() -> Optional[tuple]:
+    if _contacts is None or time.monotonic() - _fetched_at > CONTACTS_TTL:
+        return None
+
+    return _contacts, _version
+
+
+# Store freshly fetched contacts list and return its version
+def store(contacts: list) -> str:
+    global _contacts, _version, _fetched_at
+
+    snapshot = {contact['id']: _fingerprint(contact) for contact in contacts}
+    version = _fingerprint(sorted(snapshot.items()))
+
+    _contacts = contacts
+    _version = version
+    _fetched_at = time.monotonic()
+
+    _snapshots[version] = snapshot
+    _snapshots.move_to_end(version)
+    while len(_snapshots) > CONTACTS_HISTORY:
+        _snapshots.popitem(last=False)
+
+    return version
+
+
+# Drop cached list, next read fetches contacts again
+def invalidate():
+    global _contacts
+
+    _contacts = None
+
+
+# Return contacts added, changed and removed since given version
+# Returns None if version is unknown
+def delta(since: str) -> Optional[dict]:
+    previous = _snapshots.get(since)
+    if previous is None or _contacts is None:
+        return None
+
+    current = _snapshots[_version]
+    return {
+        'added': [contact for contact in _contacts if contact['id'] not in previous],
+        'changed': [
+            contact for contact in _contacts
+            if contact['id'] in previous and previous[contact['id']] != current[contact['id']]
+        ],
+        'removed': [contact_id for contact_id in previous if contact_id not in current],
+    }
+
+
+# Pyrogram raw update handler which invalidates cache on contact changes
+async def on_raw_update(client: Client, update, users: dict, chats: dict):
+    if isinstance(update, _INVALIDATING_UPDATES):
+        invalidate()
@@ -0,0 +1,158 @@
+from quart import request
+import asyncio
+import helpers
+import metrics
+import os
+import telegram
+from controllers import groups, message
+from helpers import send_alert
+from logging import error
+from typing import Optional
+
+
+# Max operations of one batch and chats handled at once
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', '1000'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '10'))
+
+# Operation name -> handler which takes params of the matching endpoint and returns its response
+HANDLERS = {
+    'message.delete': message.delete_message,
+    'message.edit': message.edit_message,
+    'message.send': message.send_message,
+    'group.members.ban': groups.ban_member,
+    'group.members.unban': groups.unban_member,
+}
+
+# Operation name -> required params, checked before anything runs
+REQUIRED = {
+    'message.delete': ['chat_id', 'message_id'],
+    'message.edit': ['chat_id', 'message_id', 'message'],
+    'message.send': ['chat_ids', 'message'],
+    'group.members.ban': ['chat_id', 'user_id'],
+    'group.members.unban': ['chat_id', 'user_id'],
+}
+
+# Response of an operation which failed on our side
+SERVER_ERROR = {'status': 500, 'message': 'something went wrong please try again later'}
+
+
+# Run many message and group operations in one request
+# params -> operations(list) of objects with op(string) and params of the matching endpoint
+# Operations are grouped per chat, chats run concurrently and operations of a chat run in order
+# Consecutive message deletes of a chat are sent as bulk deletes
+@metrics.timed
+async def run() -> dict:
+    # Check if request method is POST
+    if request.method != 'POST':
+        return {'status': 405, 'message': 'method not allowed'}
+
+    # Get data from request body
+    data = await request.get_json()
+
+    # Check if required values are filled
+    validated, null_fields = helpers.required(data, ['operations'])
+    if not validated:
+        return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
+
+    operations = data['operations']
+    if not isinstance(operations, list):
+        return {'status': 422, 'message': 'operations must be array'}
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return {'status': 422, 'message': f'at most {BATCH_MAX_OPERATIONS} operations are allowed'}
+
+    results = [None] * len(operations)
+
+    # Group valid operations per chat, keeping their order
+    chats = {}
+    for index, operation in enumerate(operations):
+        invalid = _validate(operation)
+        if invalid is not None:
+            results[index] = invalid
+            continue
+        chat_id = operation.get('chat_id', operation.get('chat_ids'))
+        chats.setdefault(str(chat_id), []).append(index)
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_chat(indexes: list):
+        async with semaphore:
+            for step in _steps(operations, indexes):
+                # A failure on our side fails operations of this step only
+                try:
+                    if len(step) > 1:
+                        await _delete_many(operations, step, results)
+                    else:
+                        results[step[0]] = await HANDLERS[operations[step[0]]['op']](operations[step[0]])
+                except Exception as e:
+                    error(f'Batch operations {step} failed: {e!r}')
+                    for index in step:
+                        results[index] = dict(SERVER_ERROR)
+
+    await asyncio.gather(*(run_chat(indexes) for indexes in chats.values()))
+
+    return {
+        'status': 200,
+        'message': 'batch done',
+        'data': [
+            {'index': index, 'op': operation.get('op') if isinstance(operation, dict) else None, **result}
+            for index, (operation, result) in enumerate(zip(operations, results))
+        ],
+    }
+
+
+# Check operation name and params, returns error response of an invalid operation
+def _validate(operation) -> Optional[dict]:
+    if not isinstance(operation, dict) or operation.get('op') not in HANDLERS:
+        return {'status': 422, 'message': 'unknown operation'}
+
+    # Lists of messages are validated item by item by their handler
+    if 'messages' in operation and operation['op'] in ('message.delete', 'message.edit'):
+        return None
+
+    validated, null_fields = helpers.required(operation, REQUIRED[operation['op']])
+    if not validated:
+        return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
+
+    chat_ids = operation.get('chat_ids', operation.get('chat_id'))
+    if not isinstance(chat_ids, list):
+        chat_ids = [chat_ids]
+    if not all(helpers.is_id(chat_id) for chat_id in chat_ids):
+        return {'status': 422, 'message': 'chat id must be integer'}
+    if 'message_id' in operation and not helpers.is_id(operation['message_id'], allow_string=False):
+        return {'status': 422, 'message': 'message id must be integer'}
+
+    return None
+
+
+# Split operations of a chat into steps, consecutive deletes share one step
+def _steps(operations: list, indexes: list) -> list:
+    steps = []
+    for index in indexes:
+        if _is_single_delete(operations[index]) and steps and _is_single_delete(operations[steps[-1][0]]):
+            steps[-1].append(index)
+        else:
+            steps.append([index])
+
+    return steps
+
+
+# Check if operation deletes one message, deletes of many messages are bulk deletes already
+def _is_single_delete(operation: dict) -> bool:
+    return operation['op'] == 'message.delete' and 'messages' not in operation
+
+
+# Delete messages of given delete operations of one chat with bulk calls, operations are validated already
+async def _delete_many(operations: list, indexes: list, results: list):
+    chat_id = operations[indexes[0]]['chat_id']
+    deleted = await telegram.delete_messages(chat_id, [operations[index]['message_id'] for index in indexes])
+
+    failed = None
+    for index, (res, em) in zip(indexes, deleted):
+        if res:
+            results[index] = {'status': 200, 'message': 'message deleted successfully'}
+        else:
+            failed = em
+            results[index] = dict(SERVER_ERROR)
+
+    if failed is not None:
+        send_alert(f'{failed}\n<b>Group id: </b>{chat_id}')
@@ -0,0 +1,41 @@
+from quart import request, jsonify
+import helpers
+import metrics
+import telegram
+
+
+# Send contacts to panel api
+# params -> since(string, optional version of previously synced list)
+# Supports If-None-Match with the returned ETag to skip unchanged lists
+@metrics.timed
+async def sync():
+    # Return error if request method was not GET
+    if request.method != 'GET':
+        return {'status': 405, 'message': 'method not allowed'}
+
+    # Stream contacts one by one if panel asked for it, streamed lists are always full
+    if helpers.stream_requested():
+        if request.args.get('since'):
+            return {'status': 422, 'message': 'since is not supported with stream'}
+        return helpers.ndjson_response(telegram.iter_contacts())
+
+    # Get contacts from cache
+    contacts, version = await telegram.get_cached_contacts()
+    headers = {'ETag': f'"{version}"'}
+
+    # Nothing changed since panel's last sync
+    if request.if_none_match.contains(version):
+        return '', 304, headers
+
+    # Return only changes if panel sent the version it already has
+    since = request.args.get('since')
+    if since:
+        delta = telegram.get_contacts_delta(since)
+        if delta is None:
+            delta = {'added': contacts, 'changed': [], 'removed': [], 'full': True}
+        else:
+            delta['full'] = False
+        delta['version'] = version
+        return delta, 200, headers
+
+    return jsonify(contacts), 200, headers
@@ -1,8 +1,12 @@
-from flask import request
+from quart import request
+import asyncio
 import helpers
+import jobs
+import metrics
 import telegram
 import os
-from logging import error, info
+from typing import AsyncIterator, Callable, Optional
+from logging import info
 from helpers import send_alert
 
 
@@ -12,74 +16,143 @@ headers = {
     'Authorization': os.getenv('API_KEY')
 }
 
+# Max groups of a batch created at once
+PROVISION_CONCURRENCY = int(os.getenv('PROVISION_CONCURRENCY', '3'))
+
 
 # Create telegram group with given title and description
-# params -> title(string), description(string)
+# params -> title(string), description(string), welcome_text(string), pin(boolean)
+# or groups(list) of objects with the same params to create a batch of groups
+@metrics.timed
 async def create() -> dict:
     # Check if request method is POST
     if request.method != 'POST':
         return {'status': 405, 'message': 'method not allowed'}
 
     # Get json data sent to us
-    data = request.json
+    data = await request.get_json()
+
+    # Create all groups of a batch concurrently
+    if 'groups' in data:
+        return await _create_batch(data['groups'])
 
     # Check if required fields are filled
     validated, null_fields = helpers.required(data, ['title', 'description'])
     if not validated:
         return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
 
-    pin = 'pin' in data and data['pin']
-
     # Create supergroup and check if it is created or not
-    chat, em = await telegram.create_group(data['title'], data['description'], data['welcome_text'], pin)
+    chat, steps = await _provision(data)
     if chat is None:
-        if len(em) > 1:
-            send_alert(f'{em}\n<b>Title: </b>{data["title"]}')
-        return {'status': 500, 'message': 'something went wrong please contact PO or try again later'}
-
-    # Convert chat object to dict
-    chat = telegram.chat_to_dict(chat)
-    # Get invite link for created group
-    chat['invite_link'] = await telegram.get_invite_link(chat['id'])
+        return {'status': 500, 'message': 'something went wrong please contact PO or try again later', 'data': steps}
 
-    # Add bot to group and promote it to admin
-    await telegram.add_chat_members(chat['id'], os.getenv('TELEGRAM_BOT_USERNAME'))
-    await telegram.promote_member(chat['id'], os.getenv('TELEGRAM_BOT_USERNAME'))
+    chat['steps'] = steps
 
     return {'status': 200, 'message': 'group created successfully', 'data': chat}
 
 
+# Create supergroup with bot and report failed steps
+async def _provision(data: dict) -> (Optional[dict], dict):
+    chat, steps = await telegram.create_group(
+        data['title'], data['description'], data.get('welcome_text'), bool(data.get('pin')),
+        os.getenv('TELEGRAM_BOT_USERNAME')
+    )
+
+    failed = {name: step['error'] for name, step in steps.items() if not step['ok']}
+    if failed:
+        details = '\n'.join(f'{name}: {em}' for name, em in failed.items())
+        send_alert(f'{details}\n<b>Title: </b>{data["title"]}')
+
+    return chat, steps
+
+
+# Create a batch of groups with bounded concurrency
+async def _create_batch(items: list) -> dict:
+    # Check if groups field is list and every group has required fields
+    if not isinstance(items, list):
+        return {'status': 422, 'message': 'groups must be array'}
+    for index, item in enumerate(items):
+        validated, null_fields = helpers.required(item, ['title', 'description'])
+        if not validated:
+            return {'status': 422, 'message': 'please fill all fields', 'data': {'index': index, 'fields': null_fields}}
+
+    semaphore = asyncio.Semaphore(PROVISION_CONCURRENCY)
+
+    async def provision(item: dict) -> dict:
+        async with semaphore:
+            chat, steps = await _provision(item)
+        return {'title': item['title'], 'created': chat is not None, 'data': chat, 'steps': steps}
+
+    results = await asyncio.gather(*(provision(item) for item in items))
+
+    return {'status': 200, 'message': 'groups created', 'data': results}
+
+
 # Archive supergroup by given chat_id
-# params -> chat_id(integer)
+# params -> chat_id(integer), async(boolean, optional to run it as a background job),
+# delete_links(boolean, optional to delete revoked invite links too)
+@metrics.timed
 async def archive() -> dict:
     # Check if request method is POST
     if request.method != 'POST':
         return {'status': 405, 'message': 'method not allowed'}
 
     # Get chat id from request body and check if chat_id has been sent to us
-    chat_id = request.json.get('id')
+    data = await request.get_json()
+    chat_id = data.get('id')
     if chat_id is None:
         return {'status': 422, 'message': 'please fill all fields'}
 
+    payload = {'chat_id': chat_id, 'delete_links': data.get('delete_links')}
+
+    # Archive big groups in background and let panel poll the job
+    if data.get('async'):
+        job = await jobs.submit('group.archive', payload)
+        return {'status': 202, 'message': 'group archive job accepted', 'data': {'job_id': job['id']}}, 202
+
     # Delete telegram group and return error on failure
-    if not await telegram.expire_group(chat_id):
+    try:
+        result = await archive_group(payload, jobs.no_progress)
+    except jobs.JobError:
         return {'status': 500, 'message': 'something went wrong please try again later or contact PO'}
 
+    return {'status': 200, 'message': 'group archived successfully', 'data': result}
+
+
+# Archive group, restrict its members and revoke invite links
+# Used by archive endpoint and background archive jobs
+@jobs.register('group.archive')
+@metrics.timed
+async def archive_group(payload: dict, progress: Callable) -> dict:
+    chat_id = payload['chat_id']
+
+    # Delete telegram group and fail on error
+    progress(step='archive')
+    is_archived, failed_members = await telegram.expire_group(chat_id, progress)
+    if not is_archived:
+        raise jobs.JobError(f'failed to archive group {chat_id}')
+
+    # Report members who can still send messages
+    if failed_members:
+        send_alert(f'Failed to restrict {len(failed_members)} members\n<b>Group id: </b>{chat_id}')
+
     # Revoke invite links
-    await telegram.revoke_chat_invite_links(chat_id)
+    progress(step='revoke_invite_links')
+    await telegram.revoke_chat_invite_links(chat_id, payload.get('delete_links'))
 
-    return {'status': 200, 'message': 'group archived successfully', 'data': {'chat_id': chat_id}}
+    return {'chat_id': chat_id, 'failed_members': failed_members}
 
 
 # Add users to an existing group
 # params -> chat_id(integer), user_ids(list)
+@metrics.timed
 async def add_chat_members() -> dict:
     # Check if request method is post
     if request.method != 'POST':
         return {'status': 405, 'message': 'method not allowed'}
 
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
 
     # Check if required values are filled
     validated, null_fields = helpers.required(data, ['chat_id', 'user_ids', 'admins'])
@@ -100,41 +173,53 @@ async def add_chat_members() -> dict:
     info(f'payload: {data}')
     info(f'user_ids: {user_ids}')
 
-    is_user_added, em = await telegram.add_chat_members(int(data['chat_id']), user_ids)
-    result = {
-        'result': is_user_added,
-        'error': em,
-    }
+    # Resolve members and admins in one batch, later calls hit the peer cache
+    await telegram.resolve_users(
+        user_ids + [admin_id for admin_id in data['admins'] if admin_id not in user_ids], data['chat_id']
+    )
 
-    info(f'result: {result}')
+    # Add users to group and get outcome of each user
+    results = await telegram.add_chat_members_bulk(int(data['chat_id']), user_ids)
+    failed = {user_id: status for user_id, status in results.items() if status != telegram.ADDED}
+
+    info(f'result: {results}')
 
-    # Add user to group and return error on failure
-    if not is_user_added:
+    # Return error if no user could be added
+    if user_ids and len(failed) == len(user_ids):
+        em = ', '.join(f'{user_id}: {status}' for user_id, status in failed.items())
         send_alert(f'{em}\n<b>Group id: </b>{data["chat_id"]}')
-        return {'status': 500, 'message': 'something went wrong please try again later or contact PO'}
+        return {
+            'status': 500,
+            'message': 'something went wrong please try again later or contact PO',
+            'data': {'results': results},
+        }
+
+    data['results'] = results
 
     # Promote admin agents to chat admin in telegram group
-    for admin_id in data['admins']:
-        try:
-            await telegram.promote_member(data['chat_id'], admin_id)
-        except Exception as e:
-            error(e)
+    data['promoted_admins'] = await telegram.promote_members(data['chat_id'], data['admins'])
 
     return {'status': 200, 'message': 'members added to group successfully', 'data': data}
 
 
 # Bans a member from an existing group
 # params -> chat_id(integer), user_id(integer)
+@metrics.timed
 async def ban_chat_member() -> dict:
     # Check if request method is POST
     if request.method != 'POST':
         return {'status': 405, 'message': 'method not allowed'}
 
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
 
     info(f'payload: {data}')
 
+    return await ban_member(data)
+
+
+# Ban one member from a group, used by ban endpoint and batch operations
+async def ban_member(data: dict) -> dict:
     # Check if required values are filled
     validated, null_fields = helpers.required(data, ['chat_id', 'user_id'])
     if not validated:
@@ -151,44 +236,155 @@ async def ban_chat_member() -> dict:
     return {'status': 200, 'message': 'member banned from group successfully', 'data': data}
 
 
+# Ban a user from every group it shares with our accounts
+# params -> user_id(integer or username), everywhere(boolean, optional to ban from every indexed group instead)
+# Results of every group are streamed as ndjson if requested
+@metrics.timed
+async def ban_everywhere():
+    # Check if request method is POST
+    if request.method != 'POST':
+        return {'status': 405, 'message': 'method not allowed'}
+
+    # Get data from request body
+    data = await request.get_json()
+
+    info(f'payload: {data}')
+
+    # Check if required values are filled
+    validated, null_fields = helpers.required(data, ['user_id'])
+    if not validated:
+        return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
+
+    results = telegram.ban_everywhere(data['user_id'], bool(data.get('everywhere')))
+    return await _fan_out_response(_alert_failures(results, 'ban', data['user_id']), 'member banned from groups')
+
+
+# Unban a user in every indexed group
+# params -> user_id(integer or username)
+# Results of every group are streamed as ndjson if requested
+@metrics.timed
+async def unban_everywhere():
+    # Check if request method is POST
+    if request.method != 'POST':
+        return {'status': 405, 'message': 'method not allowed'}
+
+    # Get data from request body
+    data = await request.get_json()
+
+    info(f'payload: {data}')
+
+    # Check if required values are filled
+    validated, null_fields = helpers.required(data, ['user_id'])
+    if not validated:
+        return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
+
+    results = telegram.unban_everywhere(data['user_id'])
+    return await _fan_out_response(_alert_failures(results, 'unban', data['user_id']), 'member unbanned in groups')
+
+
+# Stream per group results or collect them into one response
+async def _fan_out_response(results: AsyncIterator, message: str):
+    if helpers.stream_requested():
+        return helpers.ndjson_response(results)
+
+    return {'status': 200, 'message': message, 'data': [result async for result in results]}
+
+
+# Pass results through and send one alert with all failed groups at the end
+async def _alert_failures(results: AsyncIterator, action: str, user_id) -> AsyncIterator[dict]:
+    failed = []
+    async for result in results:
+        if not result['ok']:
+            failed.append(result)
+        yield result
+
+    if failed:
+        details = '\n'.join(f'{result["chat_id"]}: {result["error"]}' for result in failed)
+        send_alert(f'Failed to {action} user in {len(failed)} groups\n{details}\n<b>User id: </b>{user_id}')
+
+
 # Send groups data to panel api
+# params -> since(string, optional cursor returned by previous sync), stream(boolean, optional ndjson response)
+@metrics.timed
 async def sync_groups() -> dict:
     # Return error if request method was not GET
     if request.method != 'GET':
         return {'status': 405, 'message': 'method not allowed'}
 
-    # Get all groups
-    groups = await telegram.get_all_groups()
+    # Stream groups one by one if panel asked for it, streamed lists are always full
+    if helpers.stream_requested():
+        if request.args.get('since'):
+            return {'status': 422, 'message': 'since is not supported with stream'}
+        return helpers.ndjson_response(telegram.iter_groups())
 
-    return {'status': 200, 'data': groups}
+    # Get groups from index, only changed ones if a cursor from previous sync has been sent
+    groups, cursor, full = await telegram.get_groups(request.args.get('since'))
+
+    return {'status': 200, 'data': groups, 'cursor': cursor, 'full': full}
 
 
 # Unarchive chat with given chat id
+# params -> chat_id(integer), async(boolean, optional to run it as a background job)
+@metrics.timed
 async def unarchive() -> dict:
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
 
     # Check if required values are filled
     validated, null_fields = helpers.required(data, ['chat_id'])
     if not validated:
         return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
 
-    is_unarchived, em = await telegram.unarchive(data['chat_id'])
-    if not is_unarchived:
-        send_alert(f'{em}\nGroup id: {data["chat_id"]}')
+    # Unarchive big groups in background and let panel poll the job
+    if data.get('async'):
+        job = await jobs.submit('group.unarchive', {'chat_id': data['chat_id']})
+        return {'status': 202, 'message': 'group unarchive job accepted', 'data': {'job_id': job['id']}}, 202
+
+    try:
+        result = await unarchive_group({'chat_id': data['chat_id']}, jobs.no_progress)
+    except jobs.JobError as e:
+        send_alert(f'{e}\nGroup id: {data["chat_id"]}')
         return {'status': 500, 'message': 'something went wrong please try again later or contact PO'}
 
-    # Get invite link for created group
-    data['invite_link'] = await telegram.get_invite_link(data['chat_id'])
+    data.update(result)
 
     return {'status': 200, 'message': 'chat unarchived successfully', 'data': data}
 
 
+# Unarchive group, let members send messages again and create a new invite link
+# Used by unarchive endpoint and background unarchive jobs
+@jobs.register('group.unarchive')
+@metrics.timed
+async def unarchive_group(payload: dict, progress: Callable) -> dict:
+    chat_id = payload['chat_id']
+
+    progress(step='unarchive')
+    is_unarchived, em, failed_members = await telegram.unarchive(chat_id, progress)
+    if not is_unarchived:
+        raise jobs.JobError(em)
+
+    # Report members who still can not send messages
+    if failed_members:
+        send_alert(f'Failed to unrestrict {len(failed_members)} members\n<b>Group id: </b>{chat_id}')
+
+    # Get invite link for created group
+    progress(step='invite_link')
+    invite_link = await telegram.get_invite_link(chat_id)
+
+    return {'chat_id': chat_id, 'failed_members': failed_members, 'invite_link': invite_link}
+
+
 # Unban user from a group
+@metrics.timed
 async def unban_chat_member() -> dict:
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
+
+    return await unban_member(data)
+
 
+# Unban one user from a group, used by unban endpoint and batch operations
+async def unban_member(data: dict) -> dict:
     # Check if required values are filled
     validated, null_fields = helpers.required(data, ['chat_id', 'user_id'])
     if not validated:
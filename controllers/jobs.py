@@ -0,0 +1,18 @@
+from quart import request
+import jobs
+import metrics
+
+
+# Send status, progress and result of a background job
+# params -> job_id(string)
+@metrics.timed
+async def show(job_id: str) -> dict:
+    # Return error if request method was not GET
+    if request.method != 'GET':
+        return {'status': 405, 'message': 'method not allowed'}
+
+    job = jobs.get(job_id)
+    if job is None:
+        return {'status': 404, 'message': 'job not found'}, 404
+
+    return {'status': 200, 'data': job}
@@ -1,15 +1,26 @@
-from logging import error
-from flask import request
+from quart import request
 import helpers
+import metrics
 import telegram
 from helpers import send_alert
-from pyrogram.enums import ParseMode
+from typing import Optional
 
 
 # Edit message with given chat and message id
+# params -> chat_id(integer), message_id(integer), message(string)
+# or messages(list) of objects with the same params to edit many messages at once
+@metrics.timed
 async def edit() -> dict:
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
+
+    return await edit_message(data)
+
+
+# Edit one or many messages, used by edit endpoint and batch operations
+async def edit_message(data: dict) -> dict:
+    if data and 'messages' in data:
+        return await _edit_many(data['messages'])
 
     # Check if required values are filled
     validated, null_fields = helpers.required(data, ['chat_id', 'message_id', 'message'])
@@ -26,9 +37,20 @@ async def edit() -> dict:
 
 
 # Delete message with given chat and message id
+# params -> chat_id(integer), message_id(integer)
+# or messages(list) of objects with the same params to delete many messages at once
+@metrics.timed
 async def delete() -> dict:
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
+
+    return await delete_message(data)
+
+
+# Delete one or many messages, used by delete endpoint and batch operations
+async def delete_message(data: dict) -> dict:
+    if data and 'messages' in data:
+        return await _delete_many(data['messages'])
 
     # Check if required values are filled
     validated, null_fields = helpers.required(data, ['chat_id', 'message_id'])
@@ -44,45 +66,95 @@ async def delete() -> dict:
     return {'status': 200, 'message': 'message deleted successfully'}
 
 
+# Check if messages field is list and every message has required fields and integer ids
+def _validate_many(messages, expected: list) -> Optional[dict]:
+    if not isinstance(messages, list):
+        return {'status': 422, 'message': 'messages must be array'}
+    for index, item in enumerate(messages):
+        if not isinstance(item, dict):
+            return {'status': 422, 'message': 'messages must be array of objects', 'data': {'index': index}}
+        validated, null_fields = helpers.required(item, expected)
+        if not validated:
+            return {'status': 422, 'message': 'please fill all fields', 'data': {'index': index, 'fields': null_fields}}
+        if not helpers.is_id(item['chat_id']):
+            return {'status': 422, 'message': 'chat id must be integer', 'data': {'index': index}}
+        if not helpers.is_id(item['message_id'], allow_string=False):
+            return {'status': 422, 'message': 'message id must be integer', 'data': {'index': index}}
+
+    return None
+
+
+# Build per message results and alert failed chats once
+def _results_many(messages: list, results: list, done_key: str) -> list:
+    failed = {}
+    data = []
+    for item, (res, em) in zip(messages, results):
+        data.append({'chat_id': item['chat_id'], 'message_id': item['message_id'], done_key: res, 'error': str(em)})
+        if not res:
+            failed.setdefault(item['chat_id'], em)
+
+    for chat_id, em in failed.items():
+        send_alert(f'{em}\n<b>Group id: </b>{chat_id}')
+
+    return data
+
+
+# Edit many messages concurrently
+async def _edit_many(messages) -> dict:
+    invalid = _validate_many(messages, ['chat_id', 'message_id', 'message'])
+    if invalid is not None:
+        return invalid
+
+    results = await telegram.edit_messages(
+        [(item['chat_id'], item['message_id'], item['message']) for item in messages]
+    )
+
+    return {'status': 200, 'message': 'messages edited', 'data': _results_many(messages, results, 'edited')}
+
+
+# Delete many messages with bulk deletes per chat
+async def _delete_many(messages) -> dict:
+    invalid = _validate_many(messages, ['chat_id', 'message_id'])
+    if invalid is not None:
+        return invalid
+
+    results = await telegram.delete_messages_bulk([(item['chat_id'], item['message_id']) for item in messages])
+
+    return {'status': 200, 'message': 'messages deleted', 'data': _results_many(messages, results, 'deleted')}
+
+
 # Send message with given text to chat ids
+@metrics.timed
 async def send() -> dict:
     # Get data from request body
-    data = request.json
+    data = await request.get_json()
 
+    return await send_message(data)
+
+
+# Send message to chat ids, used by send endpoint and batch operations
+async def send_message(data: dict) -> dict:
     # Validate data and return error on failure
     validated, null_fields = helpers.required(data, ['chat_ids', 'message'])
     if not validated:
         return {'status': 422, 'message': 'please fill all fields', 'data': null_fields}
 
-    # Get client instance
-    app = await telegram.get_client()
-
-    # init skipped groups and messages lists
-    skipped_groups = []
-    messages = []
-
     # make sure chat_ids is list
     if type(data['chat_ids']) != list:
         data['chat_ids'] = [data['chat_ids']]
 
-    # get chat id from data
-    chat_id = data['chat_ids'][0]
-
-    try:
-        # send message to target chat(group)
-        message = await app.send_message(chat_id, data['message'], parse_mode=ParseMode.MARKDOWN)
-        # pin group if pin has been sent in payload
-        if 'pin' in data and data['pin']:
-            await message.pin(disable_notification=False)
-        # add message id and chat id of message to return in response
-        messages.append({'message_id': message.id, 'chat_id': message.chat.id})
-    except Exception as e:
-        error(e)
-        # add skipped group chat id which failed to message to it
-        skipped_groups.append(chat_id)
-
-    # stop client
-    await app.stop()
+    # pin can be a boolean or list of chat ids to pin message in
+    pin = data.get('pin', False)
+    if not isinstance(pin, list):
+        pin = bool(pin)
+
+    # timeout is an optional deadline in seconds, checked before any message goes out
+    timeout = data.get('timeout')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+        return {'status': 422, 'message': 'timeout must be a positive number'}
+
+    # send message to all target chats(groups) concurrently
+    messages, skipped_groups = await telegram.send_messages(data['chat_ids'], data['message'], pin, timeout)
 
     return {
         'status': 200,
@@ -0,0 +1,170 @@
+import asyncio
+import time
+from logging import error
+from typing import Dict, Optional, Union
+from pyrogram import Client, raw, utils
+from pyrogram.enums import ChatType
+from pyrogram.errors import RPCError, PeerIdInvalid, ChannelPrivate, ChatForbidden
+import scheduler
+
+
+# In process index of account groups, kept up to date from telegram updates
+# Every change bumps version, so callers can ask for changes since a cursor
+_groups: Dict[int, dict] = {}
+_version = 0
+_loaded_at = 0.0
+# Cursors of another process run are not comparable with ours
+_epoch = str(int(time.time()))
+
+# Chats waiting to be refetched after an update
+_pending_refresh = set()
+
+# Message actions which change a group's title or existence
+_REFRESH_ACTIONS = (
+    raw.types.MessageActionChatEditTitle,
+    raw.types.MessageActionChatCreate,
+    raw.types.MessageActionChannelCreate,
+    raw.types.MessageActionChatMigrateTo,
+    raw.types.MessageActionChannelMigrateFrom,
+)
+
+# Archive folder id in telegram
+ARCHIVE_FOLDER_ID = 1
+
+
+def _bump() -> int:
+    global _version
+    _version += 1
+    return _version
+
+
+# Check if index has been filled by a full scan recently
+def is_loaded(max_age: float) -> bool:
+    return _loaded_at > 0 and time.monotonic() - _loaded_at < max_age
+
+
+# Add or update a group in index
+def upsert(group: dict):
+    current = _groups.get(group['id'])
+    entry = {
+        'id': group['id'],
+        'title': group.get('title'),
+        'description': group.get('description'),
+        'archived': group.get('archived', current.get('archived') if current else None),
+    }
+
+    if current is not None and not current.get('deleted') \
+            and all(current[key] == value for key, value in entry.items()):
+        return
+
+    entry['version'] = _bump()
+    _groups[group['id']] = entry
+
+
+# Mark group as removed from account
+def remove(chat_id: int):
+    current = _groups.get(chat_id)
+    if current is None or current.get('deleted'):
+        return
+
+    _groups[chat_id] = {'id': chat_id, 'deleted': True, 'version': _bump()}
+
+
+# Set archive state of a group
+def set_archived(chat_id: Union[int, str], archived: bool):
+    current = _groups.get(int(chat_id))
+    if current is None or current.get('deleted'):
+        return
+
+    upsert({**current, 'archived': archived})
+
+
+# Replace index content with result of a full scan
+def load(groups: list):
+    global _loaded_at
+
+    ids = set()
+    for group in groups:
+        upsert(group)
+        ids.add(group['id'])
+
+    for chat_id in list(_groups):
+        if chat_id not in ids:
+            remove(chat_id)
+
+    _loaded_at = time.monotonic()
+
+
+# Return current cursor
+def cursor() -> str:
+    return f'{_epoch}:{_version}'
+
+
+# Return groups changed since given cursor, or all groups without a usable cursor
+# Second value tells if the result is the full list
+def changes(since: Optional[str] = None) -> (list, bool):
+    version = None
+    if since:
+        epoch, _, value = since.partition(':')
+        if epoch == _epoch and value.isdigit():
+            version = int(value)
+
+    if version is None:
+        groups = [entry for entry in _groups.values() if not entry.get('deleted')]
+        return [_public(entry) for entry in groups], True
+
+    groups = sorted((entry for entry in _groups.values() if entry['version'] > version), key=lambda e: e['version'])
+    return [_public(entry) for entry in groups], False
+
+
+def _public(entry: dict) -> dict:
+    return {key: value for key, value in entry.items() if key != 'version'}
+
+
+# Refetch a chat and update index with it
+async def refresh(client: Client, chat_id: int):
+    try:
+        chat = await scheduler.call(scheduler.READ, chat_id, client.get_chat, chat_id)
+    except (ChannelPrivate, ChatForbidden):
+        remove(chat_id)
+        return
+    except (RPCError, PeerIdInvalid, KeyError) as e:
+        error(f'Failed to refresh group {chat_id}: {e}')
+        return
+    finally:
+        _pending_refresh.discard(chat_id)
+
+    if chat.type == ChatType.SUPERGROUP or chat.type == ChatType.GROUP:
+        upsert({'id': chat.id, 'title': chat.title, 'description': chat.description})
+
+
+def _schedule_refresh(client: Client, chat_id: int):
+    if chat_id in _pending_refresh:
+        return
+
+    _pending_refresh.add(chat_id)
+    asyncio.get_running_loop().create_task(refresh(client, chat_id))
+
+
+# Pyrogram raw update handler which keeps index in sync
+async def on_raw_update(client: Client, update, users: dict, chats: dict):
+    # Archive state changes
+    if isinstance(update, raw.types.UpdateFolderPeers):
+        for folder_peer in update.folder_peers:
+            set_archived(utils.get_peer_id(folder_peer.peer), folder_peer.folder_id == ARCHIVE_FOLDER_ID)
+        return
+
+    # Title, description, membership or access changes
+    if isinstance(update, raw.types.UpdateChannel):
+        _schedule_refresh(client, utils.get_channel_id(update.channel_id))
+        return
+
+    if isinstance(update, raw.types.UpdateChat):
+        _schedule_refresh(client, -update.chat_id)
+        return
+
+    # Service messages of new groups and title edits
+    if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+        message = update.message
+        if isinstance(message, raw.types.MessageService) and isinstance(message.action, _REFRESH_ACTIONS):
+            _schedule_refresh(client, utils.get_peer_id(message.peer_id))
@@ -1,6 +1,33 @@
+import asyncio
+import atexit
+import functools
 import os
+import queue
+import threading
+import time
+import json
+import metrics
 import requests
+from collections import OrderedDict
 from logging import error
+from typing import AsyncIterator
+from quart import request, Response
+
+
+# Seconds to collect alerts into one digest message and timeout of bot api calls
+ALERT_DIGEST_WINDOW = float(os.getenv('ALERT_DIGEST_WINDOW', '5'))
+ALERT_TIMEOUT = float(os.getenv('ALERT_TIMEOUT', '10'))
+# Max alerts waiting for delivery, newer alerts are dropped when it is full
+ALERT_QUEUE_SIZE = int(os.getenv('ALERT_QUEUE_SIZE', '1000'))
+# Telegram rejects messages longer than this
+ALERT_MAX_LENGTH = 4000
+
+_alerts = queue.Queue(ALERT_QUEUE_SIZE)
+_alert_worker = None
+_alert_worker_lock = threading.Lock()
+_alert_session = requests.Session()
+
+metrics.Gauge('alerts_queue_depth', 'Alerts waiting for delivery', function=_alerts.qsize)
 
 
 # Checks if expected indexes are not null in a dictionary
@@ -16,17 +43,147 @@ def required(data: dict, expected: list):
     return flag, null_fields
 
 
+# Check if value is an integer id, chat ids may also be sent as numeric strings
+def is_id(value, allow_string: bool = True) -> bool:
+    if isinstance(value, str):
+        return allow_string and value.lstrip('-').isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Check if client asked for a streamed response with Accept header or stream query param
+def stream_requested() -> bool:
+    return request.args.get('stream') in ('1', 'true') \
+        or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+# Stream items of an async iterator as newline delimited json
+def ndjson_response(items: AsyncIterator) -> Response:
+    async def body():
+        try:
+            async for item in items:
+                yield json.dumps(item).encode() + b'\n'
+        except Exception as e:
+            error(e)
+            yield json.dumps({'error': 'stream interrupted'}).encode() + b'\n'
+
+    return Response(body(), mimetype='application/x-ndjson')
+
+
+# Share one running call of a coroutine function between concurrent callers with the same arguments
+def single_flight(func):
+    in_flight = {}
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            in_flight[key] = task
+            task.add_done_callback(lambda _: in_flight.pop(key, None))
+
+        # Shield shared call, so a caller which goes away does not cancel it for the others
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
 # Send alert to monitoring group on exceptions
+# Alerts are queued and delivered by a background worker, so callers never wait on bot api
 def send_alert(message: str):
+    _start_alert_worker()
+
+    try:
+        _alerts.put_nowait(str(message))
+    except queue.Full:
+        error(f'Alert queue is full, dropping alert: {message}')
+
+
+# Start alert worker thread once
+def _start_alert_worker():
+    global _alert_worker
+
+    if _alert_worker is not None:
+        return
+
+    with _alert_worker_lock:
+        if _alert_worker is None:
+            _alert_worker = threading.Thread(target=_deliver_alerts, name='alerts', daemon=True)
+            _alert_worker.start()
+
+
+# Collect alerts of a time window, merge duplicates and send them as one digest
+def _deliver_alerts():
+    while True:
+        message = _alerts.get()
+        if message is None:
+            return
+
+        # Count duplicates while keeping the order alerts arrived in
+        digest = OrderedDict({message: 1})
+        deadline = time.monotonic() + ALERT_DIGEST_WINDOW
+        stop = False
+        while not stop:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                message = _alerts.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if message is None:
+                stop = True
+                continue
+            digest[message] = digest.get(message, 0) + 1
+
+        items = [m if count == 1 else f'{m}\n<i>(repeated {count} times)</i>' for m, count in digest.items()]
+        for chunk in _split_digest(items):
+            _post_alert(chunk)
+
+        if stop:
+            return
+
+
+# Split digest items into messages which fit telegram limits
+def _split_digest(items: list) -> list:
+    chunks = []
+    current = ''
+    for item in items:
+        item = item[:ALERT_MAX_LENGTH]
+        if current and len(current) + len(item) + 2 > ALERT_MAX_LENGTH:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n\n{item}' if current else item
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+# Post message to monitoring group using pooled keep alive session
+def _post_alert(message: str):
     bot_token = os.getenv('MONITORING_BOT_TOKEN', '')
-    monitoring_group_id = int(os.getenv('MONITORING_GROUP_ID'))
     related_usernames = os.getenv('MONITORING_RELATED_USERNAMES', '')
 
     try:
-        requests.post(f'https://api.telegram.org/bot{bot_token}/sendMessage', params={
+        monitoring_group_id = int(os.getenv('MONITORING_GROUP_ID'))
+        _alert_session.post(f'https://api.telegram.org/bot{bot_token}/sendMessage', data={
             'chat_id': monitoring_group_id,
-            'message': f'<b><i>#NOC_Telegram_Account</b></i>\n\n{message}\n\n<b><i>{related_usernames}</b></i>',
+            'text': f'<b><i>#NOC_Telegram_Account</i></b>\n\n{message}\n\n<b><i>{related_usernames}</i></b>',
             'parse_mode': 'html',
-        })
-    except requests.exceptions.RequestException as e:
+        }, timeout=ALERT_TIMEOUT)
+    except (requests.exceptions.RequestException, TypeError, ValueError) as e:
         error(e)
+
+
+# Flush queued alerts on shutdown
+@atexit.register
+def _flush_alerts():
+    if _alert_worker is None:
+        return
+
+    try:
+        _alerts.put_nowait(None)
+    except queue.Full:
+        return
+    _alert_worker.join(ALERT_DIGEST_WINDOW + ALERT_TIMEOUT)
@@ -0,0 +1,145 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+from quart import request
+
+
+# Max responses kept in memory and seconds a response is replayed for its key
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '1000'))
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+# SQLite file to keep responses across restarts, empty to keep them in memory only
+IDEMPOTENCY_DB = os.getenv('IDEMPOTENCY_DB', '')
+
+# key -> {'fingerprint', 'body', 'status', 'expires_at'}
+_responses = OrderedDict()
+# key -> future of the request which is handling it right now
+_in_flight: Dict[str, asyncio.Future] = {}
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _db() -> Optional[sqlite3.Connection]:
+    global _conn
+
+    if not IDEMPOTENCY_DB:
+        return None
+
+    if _conn is None:
+        _conn = sqlite3.connect(IDEMPOTENCY_DB, check_same_thread=False)
+        _conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        _conn.execute('DELETE FROM responses WHERE expires_at < ?', (time.time(),))
+        _conn.commit()
+
+    return _conn
+
+
+def _get(key: str) -> Optional[dict]:
+    stored = _responses.get(key)
+    if stored is None and _db() is not None:
+        row = _db().execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            stored = json.loads(row[0])
+
+    if stored is None:
+        return None
+
+    if stored['expires_at'] < time.time():
+        _responses.pop(key, None)
+        return None
+
+    _responses[key] = stored
+    _responses.move_to_end(key)
+    return stored
+
+
+def _store(key: str, stored: dict):
+    _responses[key] = stored
+    _responses.move_to_end(key)
+    while len(_responses) > IDEMPOTENCY_CACHE_SIZE:
+        _responses.popitem(last=False)
+
+    if _db() is not None:
+        _db().execute(
+            'INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(stored), stored['expires_at'])
+        )
+        _db().commit()
+
+
+# Split route return value into json body and status, None if it can not be replayed
+def _normalize(response) -> Optional[tuple]:
+    status = 200
+    if isinstance(response, tuple):
+        response, status = response[0], response[1]
+
+    if not isinstance(response, (dict, list)):
+        return None
+
+    return response, status
+
+
+def _replay(stored: dict):
+    return stored['body'], stored['status'], {'Idempotent-Replayed': 'true'}
+
+
+# Replay stored response of routes called again with the same Idempotency-Key header
+# Duplicates which arrive while the first request is running wait for its response
+# Server errors are not stored, so a retry after them runs the route again
+def idempotent(func: Callable) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return await func(*args, **kwargs)
+
+        key = f'{request.path}:{key}'
+        fingerprint = hashlib.sha1(await request.get_data()).hexdigest()
+
+        while True:
+            stored = _get(key)
+            if stored is not None:
+                if stored['fingerprint'] != fingerprint:
+                    return {'status': 422, 'message': 'idempotency key has been used with another payload'}, 422
+                return _replay(stored)
+
+            future = _in_flight.get(key)
+            if future is None:
+                break
+
+            # Wait for the original request, run route ourselves if it did not store a response
+            await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        _in_flight[key] = future
+        try:
+            response = await func(*args, **kwargs)
+
+            normalized = _normalize(response)
+            if normalized is not None:
+                body, status = normalized
+                body_status = body.get('status', status) if isinstance(body, dict) else status
+                if status < 500 and body_status < 500:
+                    _store(key, {
+                        'fingerprint': fingerprint,
+                        'body': body,
+                        'status': status,
+                        'expires_at': time.time() + IDEMPOTENCY_TTL,
+                    })
+
+            return response
+        finally:
+            del _in_flight[key]
+            future.set_result(None)
+
+    return wrapper
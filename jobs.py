@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from logging import error, info
+from typing import Callable, Dict, Optional
+import metrics
+from helpers import send_alert
+
+
+# SQLite file which keeps jobs across restarts
+JOBS_DB = os.getenv('JOBS_DB', 'jobs.db')
+# Number of jobs running at once
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Times a job is run before it is marked as failed
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Seconds to wait before retrying a failed job, multiplied by attempt number
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', '30'))
+# Min seconds between two progress writes of a job
+JOB_PROGRESS_INTERVAL = float(os.getenv('JOB_PROGRESS_INTERVAL', '1'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+# Raised by job handlers to fail an attempt with a message
+class JobError(Exception):
+    pass
+
+
+# Progress callback for handlers which run outside of a job
+def no_progress(**values):
+    pass
+
+
+_handlers: Dict[str, Callable] = {}
+_queue: Optional[asyncio.Queue] = None
+_workers = []
+_conn: Optional[sqlite3.Connection] = None
+
+
+# Register coroutine function as handler of a job type
+# Handlers are called with job payload and a progress(**values) callback and return job result
+def register(kind: str):
+    def decorator(func: Callable) -> Callable:
+        _handlers[kind] = func
+        return func
+
+    return decorator
+
+
+def _db() -> sqlite3.Connection:
+    global _conn
+
+    if _conn is None:
+        _conn = sqlite3.connect(JOBS_DB, check_same_thread=False)
+        _conn.row_factory = sqlite3.Row
+        _conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        _conn.commit()
+
+    return _conn
+
+
+def _update(job_id: str, **values):
+    values['updated_at'] = time.time()
+    for key in ('progress', 'result'):
+        if key in values:
+            values[key] = json.dumps(values[key])
+
+    columns = ', '.join(f'{key} = ?' for key in values)
+    _db().execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*values.values(), job_id))
+    _db().commit()
+
+
+# Return job with given id or None
+def get(job_id: str) -> Optional[dict]:
+    row = _db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    job = dict(row)
+    for key in ('payload', 'progress', 'result'):
+        job[key] = json.loads(job[key]) if job[key] is not None else None
+
+    return job
+
+
+# Store a new job and queue it for workers
+async def submit(kind: str, payload: dict) -> dict:
+    if kind not in _handlers:
+        raise ValueError(f'Unknown job type {kind}')
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    _db().execute(
+        'INSERT INTO jobs (id, kind, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (job_id, kind, json.dumps(payload), QUEUED, now, now)
+    )
+    _db().commit()
+
+    if _queue is not None:
+        _queue.put_nowait(job_id)
+
+    return get(job_id)
+
+
+# Return number of jobs waiting for a worker
+def queue_size() -> int:
+    return _queue.qsize() if _queue is not None else 0
+
+
+metrics.Gauge('jobs_queue_depth', 'Jobs waiting for a worker', function=queue_size)
+
+
+async def _run(job_id: str):
+    job = get(job_id)
+    if job is None or job['status'] not in (QUEUED, RUNNING):
+        return
+
+    attempts = job['attempts'] + 1
+    _update(job_id, status=RUNNING, attempts=attempts)
+
+    progress = job['progress']
+    written_at = 0.0
+
+    # Merge values into job progress and persist it at most once per interval
+    def report(**values):
+        nonlocal written_at
+        progress.update(values)
+        if time.monotonic() - written_at >= JOB_PROGRESS_INTERVAL:
+            written_at = time.monotonic()
+            _update(job_id, progress=progress)
+
+    try:
+        result = await _handlers[job['kind']](job['payload'], report)
+    except Exception as e:
+        error(f'Job {job_id} ({job["kind"]}) failed on attempt {attempts}: {e}')
+        if attempts >= JOB_MAX_ATTEMPTS:
+            _update(job_id, status=FAILED, progress=progress, error=str(e))
+            send_alert(f'Job failed after {attempts} attempts\n{e}\n<b>Job: </b>{job["kind"]} {job_id}')
+            return
+
+        _update(job_id, status=QUEUED, progress=progress, error=str(e))
+        asyncio.get_running_loop().call_later(attempts * JOB_RETRY_DELAY, _queue.put_nowait, job_id)
+        return
+
+    _update(job_id, status=DONE, progress=progress, result=result, error=None)
+    info(f'Job {job_id} ({job["kind"]}) done')
+
+
+async def _worker():
+    while True:
+        job_id = await _queue.get()
+        try:
+            await _run(job_id)
+        except Exception as e:
+            error(f'Job worker failed to run {job_id}: {e}')
+        finally:
+            _queue.task_done()
+
+
+# Start workers and requeue jobs which were not finished before last shutdown
+async def start():
+    global _queue
+
+    _queue = asyncio.Queue()
+    rows = _db().execute(
+        'SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at', (QUEUED, RUNNING)
+    ).fetchall()
+    for row in rows:
+        _queue.put_nowait(row['id'])
+
+    for _ in range(JOB_WORKERS):
+        _workers.append(asyncio.get_running_loop().create_task(_worker()))
+
+
+# Stop workers, running jobs are resumed on next start
+async def stop():
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
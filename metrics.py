@@ -0,0 +1,147 @@
+import functools
+import time
+from typing import Callable, Dict, Tuple
+
+
+# Prometheus style metrics kept in process and rendered in text exposition format
+
+# Latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+def _labels(names: Tuple[str, ...], values: dict) -> Tuple[str, ...]:
+    return tuple(str(values.get(name, '')) for name in names)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Monotonically increasing value
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(self.label_names, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        return [(self.name, _format_labels(self.label_names, key), value) for key, value in self.values.items()]
+
+
+# Value which goes up and down, or is read from a function on every scrape
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), function: Callable = None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self.values[_labels(self.label_names, labels)] = value
+
+    def samples(self) -> list:
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+
+        return super().samples()
+
+
+# Distribution of observed values in cumulative buckets
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.buckets = buckets
+        # labels -> (bucket counts, sum, count)
+        self.values: Dict[Tuple[str, ...], list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _labels(self.label_names, labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = [[0] * len(self.buckets), 0.0, 0]
+            self.values[key] = entry
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self) -> list:
+        samples = []
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                samples.append((f'{self.name}_bucket', labels, bucket_count))
+            samples.append((f'{self.name}_bucket', _format_labels(self.label_names, key, 'le="+Inf"'), count))
+            samples.append((f'{self.name}_sum', _format_labels(self.label_names, key), total))
+            samples.append((f'{self.name}_count', _format_labels(self.label_names, key), count))
+
+        return samples
+
+
+# Render all metrics in prometheus text format
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling http requests', ('route', 'method', 'status')
+)
+function_duration = Histogram(
+    'function_duration_seconds', 'Time spent in telegram and controller functions', ('module', 'function')
+)
+client_start_duration = Histogram('telegram_client_start_seconds', 'Time spent starting pyrogram client')
+rpc_calls = Counter('telegram_rpc_calls_total', 'Pyrogram calls made', ('kind',))
+rpc_errors = Counter('telegram_rpc_errors_total', 'Pyrogram calls failed by error class', ('kind', 'error'))
+rpc_in_flight = Gauge('telegram_rpc_in_flight', 'Pyrogram calls running right now', ('kind',))
+flood_waits = Counter('telegram_flood_waits_total', 'FloodWait errors received', ('kind',))
+flood_wait_seconds = Counter('telegram_flood_wait_seconds_total', 'Seconds telegram asked us to wait')
+
+
+# Record duration of every call of a coroutine function
+def timed(func: Callable) -> Callable:
+    module = func.__module__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            function_duration.observe(time.perf_counter() - start, module=module, function=func.__name__)
+
+    return wrapper
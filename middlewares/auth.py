@@ -1,22 +1,79 @@
+import hashlib
+import hmac
 import os
-from werkzeug.wrappers import Request, Response
 import json
+import signal
+from logging import error, info
+from typing import Optional
+import metrics
+
+
+requests_by_key = metrics.Counter('auth_requests_total', 'Requests by api key fingerprint', ('key',))
+
+UNAUTHORIZED_BODY = json.dumps({'message': 'Authorization failed', 'status': 401}).encode()
+
+
+# Load accepted api keys from API_KEYS (comma separated, to rotate keys) and API_KEY
+# Returns key -> short fingerprint used as metrics label
+def load_keys() -> dict:
+    keys = [key.strip() for key in os.getenv('API_KEYS', '').split(',') if key.strip()]
+    if os.getenv('API_KEY'):
+        keys.append(os.getenv('API_KEY'))
+
+    if not keys:
+        error('No API_KEY or API_KEYS configured, every request will be rejected')
+
+    return {key.encode(): hashlib.sha256(key.encode()).hexdigest()[:8] for key in keys}
 
 
 class AuthMiddleware:
     def __init__(self, app):
         self.app = app
+        self.keys = load_keys()
+
+        # Reload keys on SIGHUP, so keys can be rotated without a restart
+        try:
+            signal.signal(signal.SIGHUP, self.reload)
+        except (AttributeError, ValueError) as e:
+            error(f'Failed to register SIGHUP handler for api keys: {e}')
+
+    def reload(self, *args):
+        self.keys = load_keys()
+        info(f'Reloaded {len(self.keys)} api keys')
+
+    # Compare given key with every accepted key in constant time and return its fingerprint
+    def match(self, provided: bytes) -> Optional[str]:
+        matched = None
+        for key, fingerprint in self.keys.items():
+            if hmac.compare_digest(provided, key):
+                matched = fingerprint
+
+        return matched
+
+    async def __call__(self, scope, receive, send):
+        # Let lifespan and other non http events through
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
 
-    def __call__(self, environ, start_response):
-        request = Request(environ)
+        provided = b''
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                provided = value
+                break
 
-        if request.headers.get('Authorization') != os.getenv('API_KEY'):
-            res = Response(
-                json.dumps({'message': 'Authorization failed', 'status': 401}),
-                status=401,
-                content_type='application/json'
-            )
-            return res(environ, start_response)
+        fingerprint = self.match(provided)
+        requests_by_key.inc(key=fingerprint or 'invalid')
 
-        return self.app(environ, start_response)
+        if fingerprint is None:
+            await send({
+                'type': 'http.response.start',
+                'status': 401,
+                'headers': [
+                    (b'content-type', b'application/json'),
+                    (b'content-length', str(len(UNAUTHORIZED_BODY)).encode()),
+                ],
+            })
+            await send({'type': 'http.response.body', 'body': UNAUTHORIZED_BODY})
+            return
 
+        return await self.app(scope, receive, send)
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from logging import error
+from typing import Optional, Union
+from pyrogram import Client
+import scheduler
+
+
+# Max usernames kept in cache and seconds a resolved username is trusted
+PEER_CACHE_SIZE = int(os.getenv('PEER_CACHE_SIZE', '10000'))
+PEER_CACHE_TTL = int(os.getenv('PEER_CACHE_TTL', '86400'))
+# JSON file to keep resolved usernames across restarts, empty to keep them in memory only
+PEER_CACHE_FILE = os.getenv('PEER_CACHE_FILE', '')
+# Max username resolutions running at once
+PEER_RESOLVE_CONCURRENCY = int(os.getenv('PEER_RESOLVE_CONCURRENCY', '5'))
+
+# account:username -> (user id, access hash, expires at as unix time)
+# Access hashes are only valid for the account which resolved them, so every account has its own entries
+_cache = OrderedDict()
+_loaded = False
+
+
+def _username(username: str) -> str:
+    return username.lstrip('@').lower()
+
+
+def _key(username: str, account: str) -> str:
+    return f'{account}:{_username(username)}'
+
+
+# Check if given id is a numeric user id instead of a username
+def _is_id(user_id: Union[str, int]) -> bool:
+    return isinstance(user_id, int) or str(user_id).lstrip('-').isdigit()
+
+
+def _load():
+    global _loaded
+
+    _loaded = True
+    if not PEER_CACHE_FILE or not os.path.exists(PEER_CACHE_FILE):
+        return
+
+    try:
+        with open(PEER_CACHE_FILE) as file:
+            for username, entry in json.load(file).items():
+                _cache[username] = tuple(entry)
+    except (OSError, ValueError) as e:
+        error(f'Failed to load peer cache: {e}')
+
+
+# Write cache to PEER_CACHE_FILE if configured
+def save():
+    if not PEER_CACHE_FILE:
+        return
+
+    try:
+        with open(PEER_CACHE_FILE, 'w') as file:
+            json.dump(dict(_cache), file)
+    except OSError as e:
+        error(f'Failed to save peer cache: {e}')
+
+
+# Return cached user id and access hash of username for given account
+def get(username: str, account: str = '') -> Optional[tuple]:
+    if not _loaded:
+        _load()
+
+    key = _key(username, account)
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+
+    if entry[2] < time.time():
+        del _cache[key]
+        return None
+
+    _cache.move_to_end(key)
+    return entry[0], entry[1]
+
+
+def put(username: str, user_id: int, access_hash: int, account: str = ''):
+    if not _loaded:
+        _load()
+
+    key = _key(username, account)
+    _cache[key] = (user_id, access_hash, time.time() + PEER_CACHE_TTL)
+    _cache.move_to_end(key)
+    while len(_cache) > PEER_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+# Resolve username to user id, using cache before asking telegram
+# Cached peers are put back into client storage, so pyrogram can use the id without resolving it again
+async def resolve(client: Client, username: Union[str, int]) -> int:
+    if _is_id(username):
+        return int(username)
+
+    cached = get(username, client.name)
+    if cached is not None:
+        user_id, access_hash = cached
+        try:
+            await client.storage.get_peer_by_id(user_id)
+        except KeyError:
+            await client.storage.update_peers([(user_id, access_hash, 'user', _username(username), None)])
+        return user_id
+
+    peer = await scheduler.call(scheduler.READ, None, client.resolve_peer, username)
+    if not hasattr(peer, 'user_id'):
+        raise ValueError(f'{username} is not a user')
+
+    put(username, peer.user_id, peer.access_hash, client.name)
+    return peer.user_id
+
+
+# Resolve a batch of usernames concurrently
+# Returns username -> user id, or the exception raised while resolving it
+async def resolve_many(client: Client, usernames: list) -> dict:
+    semaphore = asyncio.Semaphore(PEER_RESOLVE_CONCURRENCY)
+
+    async def run(username):
+        async with semaphore:
+            return await resolve(client, username)
+
+    results = await asyncio.gather(*(run(username) for username in usernames), return_exceptions=True)
+    return dict(zip(usernames, results))
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import time
+from logging import warning
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple, Union
+from pyrogram.errors import FloodWait, RPCError
+import accounts
+import metrics
+
+
+# Method classes which share a rate limit
+MESSAGES = 'messages'
+MEMBERS = 'members'
+ADMIN = 'admin'
+READ = 'read'
+
+# Give up and raise FloodWait if telegram asks us to wait longer than this (seconds)
+FLOOD_WAIT_MAX = int(os.getenv('FLOOD_WAIT_MAX', '300'))
+# Max times a call is resubmitted after FloodWait
+FLOOD_WAIT_RETRIES = int(os.getenv('FLOOD_WAIT_RETRIES', '5'))
+# Items iterated calls get per request, pyrogram fetches pages of get_dialogs and similar calls in this size
+ITERATE_PAGE_SIZE = 100
+
+
+# Token bucket which refills rate tokens per second up to capacity
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.parked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Stop handing out tokens for given seconds
+    def park(self, seconds: float):
+        self.parked_until = max(self.parked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    # Wait until a token is available and take it
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.parked_until:
+                await asyncio.sleep(self.parked_until - now)
+                continue
+
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Read "rate:burst" bucket config from env, e.g. RATE_LIMIT_MESSAGES=5:10
+def _bucket_from_env(name: str, rate: float, burst: float) -> TokenBucket:
+    value = os.getenv(f'RATE_LIMIT_{name.upper()}')
+    if value:
+        rate, _, burst = value.partition(':')
+        rate = float(rate)
+        burst = float(burst or rate)
+
+    return TokenBucket(rate, burst)
+
+
+# Default rate and burst of each method class
+_LIMITS = {
+    MESSAGES: (5, 10),
+    MEMBERS: (5, 10),
+    ADMIN: (2, 5),
+    READ: (5, 10),
+}
+
+# Buckets of each account and method class, created on first use
+# Telegram limits every account on its own, so accounts in the pool do not share buckets
+_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+# Per chat buckets of each method class, created on first use
+_chat_buckets: Dict[Tuple[str, Union[int, str]], TokenBucket] = {}
+
+
+def _chat_bucket(kind: str, chat_id: Union[int, str]) -> TokenBucket:
+    bucket = _chat_buckets.get((kind, chat_id))
+    if bucket is None:
+        bucket = _bucket_from_env('chat', 3, 5)
+        _chat_buckets[(kind, chat_id)] = bucket
+
+    return bucket
+
+
+def _bucket(account: str, kind: str) -> TokenBucket:
+    bucket = _buckets.get((account, kind))
+    if bucket is None:
+        bucket = _bucket_from_env(kind, *_LIMITS[kind])
+        _buckets[(account, kind)] = bucket
+
+    return bucket
+
+
+# Return session name of the account which makes a call
+# func is a bound method of a pyrogram client or of an object returned by it, like message.pin
+def _account(func: Callable) -> str:
+    owner = getattr(func, '__self__', None)
+    client = getattr(owner, '_client', owner)
+    return getattr(client, 'name', '')
+
+
+# Wait for tokens of account, method class and chat
+async def _acquire(account: str, kind: str, chat_id: Optional[Union[int, str]]):
+    await _bucket(account, kind).acquire()
+    if chat_id is not None:
+        await _chat_bucket(kind, chat_id).acquire()
+
+
+# Park method class of account and chat after a FloodWait, returns False if we should give up
+def _park(account: str, kind: str, chat_id: Optional[Union[int, str]], e: FloodWait, attempt: int) -> bool:
+    metrics.flood_waits.inc(kind=kind)
+    metrics.flood_wait_seconds.inc(e.value)
+    if e.value > FLOOD_WAIT_MAX or attempt > FLOOD_WAIT_RETRIES:
+        return False
+
+    warning(f'FloodWait of {e.value}s on {kind} calls of {account} (chat {chat_id}), attempt {attempt}')
+    _bucket(account, kind).park(e.value)
+    if chat_id is not None:
+        _chat_bucket(kind, chat_id).park(e.value)
+
+    return True
+
+
+# Run a pyrogram call under rate limits and resubmit it after FloodWait
+# Own arguments are positional only, so func can still take chat_id as a keyword
+async def call(kind: str, chat_id: Optional[Union[int, str]], func: Callable, /, *args, **kwargs):
+    account = _account(func)
+    attempt = 0
+    while True:
+        await _acquire(account, kind, chat_id)
+        metrics.rpc_calls.inc(kind=kind)
+        metrics.rpc_in_flight.inc(kind=kind)
+        accounts.started(account)
+        try:
+            return await func(*args, **kwargs)
+        except FloodWait as e:
+            metrics.rpc_errors.inc(kind=kind, error=type(e).__name__)
+            attempt += 1
+            if not _park(account, kind, chat_id, e, attempt):
+                raise
+        except RPCError as e:
+            metrics.rpc_errors.inc(kind=kind, error=type(e).__name__)
+            raise
+        finally:
+            metrics.rpc_in_flight.dec(kind=kind)
+            accounts.finished(account)
+
+
+# Iterate a pyrogram async generator under rate limits, taking a token for every page it fetches
+# After FloodWait the iteration is restarted and already yielded items are skipped
+async def iterate(kind: str, chat_id: Optional[Union[int, str]], func: Callable, /, *args,
+                  **kwargs) -> AsyncIterator:
+    account = _account(func)
+    attempt = 0
+    yielded = 0
+    while True:
+        await _acquire(account, kind, chat_id)
+        metrics.rpc_calls.inc(kind=kind)
+        skip = yielded
+        received = 0
+        try:
+            async for item in func(*args, **kwargs):
+                received += 1
+                if skip:
+                    skip -= 1
+                else:
+                    yield item
+                    yielded += 1
+
+                # Next item comes from a new page
+                if received % ITERATE_PAGE_SIZE == 0:
+                    await _acquire(account, kind, chat_id)
+                    metrics.rpc_calls.inc(kind=kind)
+            return
+        except FloodWait as e:
+            metrics.rpc_errors.inc(kind=kind, error=type(e).__name__)
+            attempt += 1
+            if not _park(account, kind, chat_id, e, attempt):
+                raise
+        except RPCError as e:
+            metrics.rpc_errors.inc(kind=kind, error=type(e).__name__)
+            raise
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sqlite3
+from logging import error
+from typing import Optional
+from pyrogram.storage import MemoryStorage
+
+
+# Seconds between snapshots of in memory sessions to disk, 0 to write them only on shutdown
+SESSION_SNAPSHOT_INTERVAL = int(os.getenv('SESSION_SNAPSHOT_INTERVAL', '60'))
+
+
+# Pyrogram session storage which keeps auth key and peers in an in memory SQLite database
+# It is loaded from the session file on open and written back to it periodically and on close,
+# so resolving peers does not touch the disk on every call
+class SnapshotStorage(MemoryStorage):
+    def __init__(self, name: str, path: str, interval: int = SESSION_SNAPSHOT_INTERVAL):
+        super().__init__(name)
+        self.path = path
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        # Value of conn.total_changes at last snapshot, used to skip unchanged sessions
+        self._snapshot_changes = -1
+
+    async def open(self):
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+
+        if os.path.exists(self.path):
+            disk = sqlite3.connect(self.path)
+            try:
+                disk.backup(self.conn)
+            finally:
+                disk.close()
+        else:
+            self.create()
+
+        self._snapshot_changes = self.conn.total_changes
+        if self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        # Last snapshot is written before the connection goes away
+        copy = self._copy()
+        if copy is not None:
+            self._write(copy)
+        self.conn.close()
+
+    # Copy in memory database, None if nothing changed since last snapshot
+    def _copy(self) -> Optional[sqlite3.Connection]:
+        self.conn.commit()
+        if self.conn.total_changes == self._snapshot_changes:
+            return None
+
+        copy = sqlite3.connect(':memory:', check_same_thread=False)
+        self.conn.backup(copy)
+        self._snapshot_changes = self.conn.total_changes
+        return copy
+
+    # Write copy to session file, replacing it at once so a crash never leaves a half written file
+    def _write(self, copy: sqlite3.Connection):
+        temp = f'{self.path}.tmp'
+        try:
+            disk = sqlite3.connect(temp)
+            try:
+                copy.backup(disk)
+            finally:
+                disk.close()
+            os.replace(temp, self.path)
+        except (sqlite3.Error, OSError) as e:
+            error(f'Failed to snapshot session {self.name}: {e}')
+            # Try again on next snapshot
+            self._snapshot_changes = -1
+        finally:
+            copy.close()
+
+    # Snapshot on the event loop, which is cheap in memory, and write file in a thread
+    async def snapshot(self):
+        copy = self._copy()
+        if copy is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, copy)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.snapshot()
@@ -1,18 +1,140 @@
-from pyrogram import Client, types
+from pyrogram import Client, raw, types, utils
+from pyrogram.handlers import RawUpdateHandler
+from pyrogram.raw.functions import Ping
 from pyrogram.raw.functions.channels import TogglePreHistoryHidden, CreateForumTopic
-from pyrogram.enums import ChatType
+from pyrogram.enums import ChatType, ParseMode
 from pyrogram.errors import (
-    RPCError, PeerIdInvalid, FloodWait, ChatAdminRequired, UserPrivacyRestricted, ChannelAddInvalid
+    RPCError, PeerIdInvalid, FloodWait, UserPrivacyRestricted, UserNotMutualContact, UserChannelsTooMuch,
+    UserKicked, UserIdInvalid, InputUserDeactivated, UsernameInvalid, UsernameNotOccupied, InternalServerError
 )
+import accounts
+import asyncio
+import contacts_cache
+import directory
+import helpers
+import metrics
 import os
+import peers
+import random
+import scheduler
+import time
 from logging import error
 from pyrogram.enums import ChatMemberStatus
-from typing import Optional, Union
+from typing import AsyncIterator, Callable, Dict, Optional, Union
 from pyrogram.types import Chat
+from session_storage import SnapshotStorage
+
+
+# Shared pyrogram clients per account, started once and reused by every call in this module
+_clients: Dict[str, Client] = {}
+_client_locks: Dict[str, asyncio.Lock] = {}
+_client_lock_loop: Optional[asyncio.AbstractEventLoop] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_client_checked_at: Dict[str, float] = {}
+# Account user of every client, fetched once per process
+_me: Dict[str, types.User] = {}
+
+# Directory of session files, pyrogram would default to the directory of the started script, uvicorn's bin
+TELEGRAM_WORKDIR = os.getenv('TELEGRAM_WORKDIR', os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds between liveness pings of the shared client
+HEALTH_CHECK_INTERVAL = int(os.getenv('TELEGRAM_HEALTH_CHECK_INTERVAL', '60'))
+HEALTH_CHECK_TIMEOUT = int(os.getenv('TELEGRAM_HEALTH_CHECK_TIMEOUT', '10'))
+
+# Max parallel sends and per request deadline (seconds) of message broadcasts
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_TIMEOUT = float(os.getenv('BROADCAST_TIMEOUT', '60'))
+
+# Seconds after which groups index is rebuilt with a full dialogs scan
+DIRECTORY_RESYNC_INTERVAL = int(os.getenv('DIRECTORY_RESYNC_INTERVAL', '3600'))
+
+# Max message ids telegram accepts in one delete call
+DELETE_MESSAGES_LIMIT = 100
+# Max chats cleaned up or messages edited at once by bulk message calls
+MESSAGES_BULK_CONCURRENCY = int(os.getenv('MESSAGES_BULK_CONCURRENCY', '10'))
+
+# Users added in one call and chunks added at once while adding members in bulk
+BULK_ADD_CHUNK_SIZE = int(os.getenv('BULK_ADD_CHUNK_SIZE', '20'))
+BULK_ADD_CONCURRENCY = int(os.getenv('BULK_ADD_CONCURRENCY', '3'))
+
+# Outcomes of adding a user to a group
+ADDED = 'added'
+PRIVACY_RESTRICTED = 'privacy_restricted'
+INVALID = 'invalid'
+FLOOD_DEFERRED = 'flood_deferred'
+FAILED = 'failed'
+
+# Errors which point to a user, not the whole chunk
+_INVALID_USER_ERRORS = (
+    PeerIdInvalid, UserIdInvalid, InputUserDeactivated, UsernameInvalid, UsernameNotOccupied, KeyError, ValueError
+)
+_USER_ADD_ERRORS = (UserPrivacyRestricted, UserNotMutualContact, UserChannelsTooMuch, UserKicked) + _INVALID_USER_ERRORS
+
+# Max groups a user is banned from or unbanned in at once by cross group calls
+MEMBERS_FAN_OUT_CONCURRENCY = int(os.getenv('MEMBERS_FAN_OUT_CONCURRENCY', '10'))
+# Max chats telegram returns in one common chats call
+COMMON_CHATS_LIMIT = 100
+
+# Max invite links revoked at once and whether revoked links are deleted afterwards by default
+REVOKE_CONCURRENCY = int(os.getenv('REVOKE_CONCURRENCY', '5'))
+DELETE_REVOKED_INVITE_LINKS = os.getenv('DELETE_REVOKED_INVITE_LINKS', 'False') == 'True'
+
+# Max promotions running at once
+PROMOTE_CONCURRENCY = int(os.getenv('PROMOTE_CONCURRENCY', '5'))
+
+# Max parallel restrict calls and retries per member while changing member permissions
+PERMISSIONS_CONCURRENCY = int(os.getenv('PERMISSIONS_CONCURRENCY', '10'))
+PERMISSIONS_RETRIES = int(os.getenv('PERMISSIONS_RETRIES', '2'))
+# Errors after which changing permissions of a member is tried again, FloodWait is retried by the scheduler
+_TRANSIENT_ERRORS = (InternalServerError, asyncio.TimeoutError, OSError)
+# Archive and unarchive groups with one chat wide permissions call instead of restricting every member
+CHAT_WIDE_PERMISSIONS = os.getenv('CHAT_WIDE_PERMISSIONS', 'False') == 'True'
+
+# Default permissions of members in our groups
+DEFAULT_CHAT_PERMISSIONS = types.ChatPermissions(
+    can_invite_users=False,
+    can_change_info=False,
+    can_send_polls=True,
+    can_pin_messages=True,
+    can_send_media_messages=True,
+    can_send_other_messages=True,
+    can_send_messages=True,
+    can_add_web_page_previews=True,
+)
+
+# Named admin privileges used when promoting members
+_FULL_PRIVILEGES = types.ChatPrivileges(
+    can_delete_messages=True,
+    can_restrict_members=True,
+    can_promote_members=True,
+    can_invite_users=True,
+    can_manage_chat=True,
+    can_manage_video_chats=True,
+    can_change_info=True,
+    can_pin_messages=True,
+    can_edit_messages=True,
+    can_post_messages=True,
+)
+PRIVILEGE_PROFILES = {
+    'admin': _FULL_PRIVILEGES,
+    'bot': _FULL_PRIVILEGES,
+}
+
+# Permissions of members in archived groups
+ARCHIVED_CHAT_PERMISSIONS = types.ChatPermissions(
+    can_send_messages=False,
+    can_send_media_messages=False,
+    can_send_other_messages=False,
+    can_send_polls=False,
+    can_add_web_page_previews=False,
+    can_change_info=False,
+    can_invite_users=False,
+    can_pin_messages=False,
+)
 
 
-# Return started pyrogram client
-async def get_client() -> Client:
+# Build a new pyrogram client of given account session from env variables
+def _build_client(name: str) -> Client:
     proxy = None
     if os.getenv('TELEGRAM_ACCOUNT_PROXY_ENABLED', 'True') == 'True':
         proxy = {
@@ -21,54 +143,248 @@ async def get_client() -> Client:
             'port': int(os.getenv('PROXY_PORT'))
         }
 
-    app = Client('account', os.getenv("API_ID"), os.getenv("API_HASH"), proxy=proxy)
-    await app.start()
+    app = Client(name, os.getenv("API_ID"), os.getenv("API_HASH"), proxy=proxy, workdir=TELEGRAM_WORKDIR)
+    # Keep session in memory and snapshot it to the usual session file
+    app.storage = SnapshotStorage(name, os.path.join(TELEGRAM_WORKDIR, f'{name}.session'))
+
+    # Keep groups index in sync with account updates
+    app.add_handler(RawUpdateHandler(directory.on_raw_update))
+    # Drop cached contacts when they change
+    app.add_handler(RawUpdateHandler(contacts_cache.on_raw_update), group=1)
+
     return app
 
 
-# Create telegram group with given title and description
-# Returns true if group created successfully and false in failure
-async def create_group(title: str, description: str, welcome_text: str, pin: bool = False) -> (Optional['Chat'], str):
-    # Get pyrogram client
-    app = await get_client()
+# Check if shared client is usable on the running event loop
+def _is_healthy(app: Optional[Client]) -> bool:
+    if app is None or not app.is_connected:
+        return False
+
+    # Client objects are bound to the loop they were started on
+    return _client_loop is asyncio.get_running_loop()
 
+
+# Ping telegram servers to make sure the connection is still alive
+async def _ping(app: Client) -> bool:
     try:
-        # Create supergroup with given title and description
-        chat = await app.create_supergroup(title, description)
+        await asyncio.wait_for(app.invoke(Ping(ping_id=random.randint(0, 2 ** 31))), HEALTH_CHECK_TIMEOUT)
+    except (RPCError, ConnectionError, OSError, asyncio.TimeoutError) as e:
+        error(f'Telegram client health check failed: {e}')
+        return False
 
-        # Send welcome message
-        message = await app.send_message(chat.id, welcome_text)
-        if pin:
-            await message.pin(disable_notification=False)
+    return True
+
+
+# Return started pyrogram client, (re)connecting the shared one if needed
+# Client of the account which owns chat_id is returned, or of given account, or of the default account
+async def get_client(chat_id: Optional[Union[str, int]] = None, account: Optional[str] = None) -> Client:
+    global _client_lock_loop, _client_loop
+
+    name = account or accounts.owner(chat_id) or accounts.default()
+    app = _clients.get(name)
+
+    if _is_healthy(app):
+        if time.monotonic() - _client_checked_at.get(name, 0.0) < HEALTH_CHECK_INTERVAL:
+            return app
+        _client_checked_at[name] = time.monotonic()
+        if await _ping(app):
+            return app
+        # Force reconnect on next step
+        _client_checked_at[name] = 0.0
+
+    loop = asyncio.get_running_loop()
+    if _client_lock_loop is not loop:
+        _client_locks.clear()
+        _client_lock_loop = loop
+    if name not in _client_locks:
+        _client_locks[name] = asyncio.Lock()
+
+    async with _client_locks[name]:
+        app = _clients.get(name)
+        if _is_healthy(app) and _client_checked_at.get(name):
+            return app
+
+        # Drop stale client before reconnecting
+        if app is not None and _client_loop is loop:
+            try:
+                await app.stop()
+            except (RPCError, ConnectionError, OSError) as e:
+                error(e)
+
+        app = _build_client(name)
+        start = time.perf_counter()
+        await app.start()
+        metrics.client_start_duration.observe(time.perf_counter() - start)
+
+        _clients[name] = app
+        _client_loop = loop
+        _client_checked_at[name] = time.monotonic()
+
+    return app
+
+
+# Return account user of a client, cached for the life of the process
+async def get_me(app: Client) -> types.User:
+    me = _me.get(app.name)
+    if me is None:
+        me = await scheduler.call(scheduler.READ, None, app.get_me)
+        _me[app.name] = me
+
+    return me
+
+
+# Return started clients of all accounts in the pool
+async def get_clients() -> list:
+    return [await get_client(account=name) for name in accounts.ACCOUNTS]
+
+
+# Stop shared pyrogram clients, used on service shutdown
+async def stop_client():
+    peers.save()
+
+    for name, app in list(_clients.items()):
+        try:
+            if app.is_connected:
+                await app.stop()
+        except (RPCError, ConnectionError, OSError) as e:
+            error(e)
+
+    _clients.clear()
+
+
+# Create telegram group with given title and description
+# After the supergroup exists, welcome message, permissions, invite link and bot setup run concurrently
+# Returns chat dict with invite link (None if group was not created) and status of each step
+@metrics.timed
+async def create_group(title: str, description: str, welcome_text: Optional[str] = None, pin: bool = False,
+                       bot_username: Optional[str] = None) -> (Optional[dict], dict):
+    # New groups go to the account which owns fewest groups
+    account = accounts.least_loaded()
+    app = await get_client(account=account)
+
+    # Create supergroup with given title and description
+    try:
+        chat = await scheduler.call(scheduler.ADMIN, None, app.create_supergroup, title, description)
     except (RPCError, PeerIdInvalid) as e:
         error(e)
-        return None, e
+        return None, {'create': {'ok': False, 'error': str(e)}}
+
     # Check if group created or not
     if not isinstance(chat, types.Chat):
-        return None, ''
+        return None, {'create': {'ok': False, 'error': 'unexpected create_supergroup result'}}
+
+    # Remember owner, so later calls for this group use the same account
+    accounts.assign(chat.id, account)
+    directory.upsert(chat_to_dict(chat))
+    steps = {'create': {'ok': True}}
+
+    # Send welcome message
+    async def welcome():
+        message = await scheduler.call(scheduler.MESSAGES, chat.id, app.send_message, chat.id, welcome_text)
+        if pin:
+            await scheduler.call(scheduler.MESSAGES, chat.id, message.pin, disable_notification=False)
 
-    em = ''
     # Set group permissions
-    try:
-        await app.set_chat_permissions(chat.id, types.ChatPermissions(
-            can_invite_users=False,
-            can_change_info=False,
-            can_send_polls=True,
-            can_pin_messages=True,
-            can_send_media_messages=True,
-            can_send_other_messages=True,
-            can_send_messages=True,
-            can_add_web_page_previews=True,
-        ))
+    async def permissions():
+        await scheduler.call(scheduler.ADMIN, chat.id, app.set_chat_permissions, chat.id, DEFAULT_CHAT_PERMISSIONS)
         TogglePreHistoryHidden(channel=chat, enabled=True)
         CreateForumTopic(channel=chat, title='Announcements', random_id=85)
-    except (RPCError, PeerIdInvalid) as e:
-        error(e)
-        em = e
 
-    # Stop client
-    await app.stop()
-    return chat, em
+    # Get invite link for created group
+    async def invite_link() -> str:
+        link = await get_invite_link(chat.id)
+        if not link:
+            raise ValueError('failed to create invite link')
+        return link
+
+    # Add bot to group and promote it to admin
+    async def bot():
+        is_added, em = await add_chat_members(chat.id, bot_username)
+        if not is_added:
+            raise ValueError(f'failed to add bot: {em}')
+        if not await promote_member(chat.id, bot_username, 'bot'):
+            raise ValueError('failed to promote bot')
+
+    pipeline = {'permissions': permissions(), 'invite_link': invite_link()}
+    if welcome_text:
+        pipeline['welcome'] = welcome()
+    if bot_username:
+        pipeline['bot'] = bot()
+
+    results = await asyncio.gather(*pipeline.values(), return_exceptions=True)
+
+    chat = chat_to_dict(chat)
+    chat['invite_link'] = ''
+    for name, result in zip(pipeline, results):
+        if isinstance(result, Exception):
+            error(f'Group {chat["id"]} step {name} failed: {result}')
+            steps[name] = {'ok': False, 'error': str(result)}
+            continue
+
+        steps[name] = {'ok': True}
+        if name == 'invite_link':
+            chat['invite_link'] = result
+
+    return chat, steps
+
+
+# Send message to all given chats with bounded concurrency
+# pin can be a boolean for all chats or a list of chat ids to pin message in
+# Returns sent messages and chat ids which failed or missed the deadline
+@metrics.timed
+async def send_messages(chat_ids: list, text: str, pin: Union[bool, list] = False,
+                        timeout: Optional[float] = None) -> (list, list):
+    # Every chat is sent from its owning account, each account with its own concurrency
+    semaphores = {name: asyncio.Semaphore(BROADCAST_CONCURRENCY) for name in accounts.ACCOUNTS}
+
+    async def send(chat_id: Union[str, int]) -> dict:
+        app = await get_client(chat_id)
+        async with semaphores[app.name]:
+            # send message to target chat(group)
+            message = await scheduler.call(
+                scheduler.MESSAGES, chat_id, app.send_message, chat_id, text, parse_mode=ParseMode.MARKDOWN
+            )
+            result = {'message_id': message.id, 'chat_id': message.chat.id, 'pinned': False}
+
+            # pin message if requested for this chat
+            if pin is True or (isinstance(pin, list) and chat_id in pin):
+                try:
+                    await scheduler.call(scheduler.MESSAGES, chat_id, message.pin, disable_notification=False)
+                    result['pinned'] = True
+                except (RPCError, PeerIdInvalid) as e:
+                    error(e)
+
+            return result
+
+    # Fan out sends and wait until all of them are done or deadline is reached
+    tasks = {asyncio.ensure_future(send(chat_id)): chat_id for chat_id in chat_ids}
+    if not tasks:
+        return [], []
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=timeout or BROADCAST_TIMEOUT)
+    except BaseException:
+        # Leave no sends running behind a failed or cancelled request
+        for task in tasks:
+            task.cancel()
+        raise
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    messages = []
+    skipped_groups = []
+    for task, chat_id in tasks.items():
+        if task in done and task.exception() is None:
+            messages.append(task.result())
+            continue
+
+        if task in done:
+            error(task.exception())
+        else:
+            error(f'Sending message to {chat_id} missed the deadline')
+        skipped_groups.append(chat_id)
+
+    return messages, skipped_groups
 
 
 # Converts chat object to dictionary
@@ -81,296 +397,677 @@ def chat_to_dict(chat: Chat) -> dict:
 
 
 # Delete supergroup and return a boolean which shows if its deleted or not
-async def expire_group(chat_id: Union[str, int]):
+# with list of member ids whose permissions could not be changed
+@metrics.timed
+async def expire_group(chat_id: Union[str, int], progress: Optional[Callable] = None) -> (bool, list):
     # Get pyrogram client
-    app = await get_client()
+    app = await get_client(chat_id)
 
     # Delete supergroup
     try:
-        boolean = await app.archive_chats([chat_id])
+        boolean = await scheduler.call(scheduler.ADMIN, chat_id, app.archive_chats, [chat_id])
     except (RPCError, PeerIdInvalid) as e:
         error(e)
         boolean = False
 
+    failed = []
     try:
-        await change_all_chat_members_permissions(app, chat_id)
+        _, failed = await change_all_chat_members_permissions(app, chat_id, progress=progress)
     except (RPCError, PeerIdInvalid) as e:
         error(e)
         boolean = False
         try:
-            await app.unarchive_chats([chat_id])
+            await scheduler.call(scheduler.ADMIN, chat_id, app.unarchive_chats, [chat_id])
         except (RPCError, PeerIdInvalid) as e:
             error(e)
 
-    # Stop client
-    await app.stop()
-    return boolean
+    if boolean:
+        directory.set_archived(chat_id, True)
+
+    return boolean, failed
 
 
 # Add members to an existing group
-async def add_chat_members(chat_id: Union[str, int], user_ids: Union[dict, list]) -> (bool, str):
+# Returns true if at least one user has been added and errors of the others
+@metrics.timed
+async def add_chat_members(chat_id: Union[str, int], user_ids: Union[str, int, list]) -> (bool, str):
+    if not isinstance(user_ids, list):
+        user_ids = [user_ids]
+
+    results = await add_chat_members_bulk(chat_id, user_ids)
+    failed = {user_id: status for user_id, status in results.items() if status != ADDED}
+    em = ', '.join(f'{user_id}: {status}' for user_id, status in failed.items())
+
+    return not user_ids or len(failed) < len(user_ids), em
+
+
+# Add members to an existing group in chunks
+# Usernames are resolved first, chunks are added concurrently and a failed chunk is retried user by user
+# Returns outcome of each user: added, privacy_restricted, invalid, flood_deferred or failed
+@metrics.timed
+async def add_chat_members_bulk(chat_id: Union[str, int], user_ids: list) -> dict:
     # Get pyrogram client
-    app = await get_client()
+    app = await get_client(chat_id)
 
-    em = ''
-    res = True
+    results = {}
 
-    # Add users to group
-    try:
-        res = await app.add_chat_members(chat_id, user_ids)
-    except (RPCError, PeerIdInvalid, FloodWait, ChatAdminRequired, ChannelAddInvalid, UserPrivacyRestricted) as e:
-        error(e)
-        em = e
-        # send_alert(f'Failed to add group members for id {chat_id}\n\n{e}')
-        if len(user_ids) == 1:
-            res = False
+    # Resolve usernames to user ids ahead of adding them
+    resolved = {}
+    for user_id, result in (await peers.resolve_many(app, user_ids)).items():
+        if isinstance(result, Exception):
+            error(f'Failed to resolve {user_id}: {result}')
+            results[user_id] = _add_outcome(result)
+        else:
+            resolved[user_id] = result
 
-    await app.stop()
-    return res, em
+    # Add a chunk of users, on user level errors add them one by one to find who failed
+    async def add(chunk: list):
+        try:
+            await scheduler.call(
+                scheduler.MEMBERS, chat_id, app.add_chat_members, chat_id, [resolved[user_id] for user_id in chunk]
+            )
+        except _USER_ADD_ERRORS as e:
+            if len(chunk) > 1:
+                for user_id in chunk:
+                    await add([user_id])
+                return
+            error(f'Failed to add {chunk[0]} to chat {chat_id}: {e}')
+            results[chunk[0]] = _add_outcome(e)
+            return
+        except (RPCError, PeerIdInvalid, KeyError) as e:
+            error(f'Failed to add {len(chunk)} users to chat {chat_id}: {e}')
+            for user_id in chunk:
+                results[user_id] = _add_outcome(e)
+            return
+
+        for user_id in chunk:
+            results[user_id] = ADDED
+
+    ids = [user_id for user_id in user_ids if user_id in resolved]
+    chunks = [ids[i:i + BULK_ADD_CHUNK_SIZE] for i in range(0, len(ids), BULK_ADD_CHUNK_SIZE)]
+    await _bounded_gather(add, chunks, BULK_ADD_CONCURRENCY)
+
+    return {user_id: results.get(user_id, FAILED) for user_id in user_ids}
+
+
+# Map error of adding a user to its outcome
+def _add_outcome(e: Exception) -> str:
+    if isinstance(e, FloodWait):
+        return FLOOD_DEFERRED
+    if isinstance(e, UserPrivacyRestricted):
+        return PRIVACY_RESTRICTED
+    if isinstance(e, _INVALID_USER_ERRORS):
+        return INVALID
+
+    return FAILED
 
 
 # Remove member from a group
+@metrics.timed
 async def ban_chat_member(chat_id: Union[str, int], user_id: Union[str, int]) -> (bool, str):
     # Get pyrogram client
-    app = await get_client()
+    app = await get_client(chat_id)
 
     em = ''
 
     # Ban a member from group
     try:
-        res = await app.ban_chat_member(int(chat_id), int(user_id))
-    except (RPCError, PeerIdInvalid) as e:
+        user_id = await peers.resolve(app, user_id)
+        res = await scheduler.call(scheduler.MEMBERS, chat_id, app.ban_chat_member, int(chat_id), user_id)
+    except (RPCError, PeerIdInvalid, ValueError) as e:
         error(e)
         em = e
         res = False
 
-    # Stop client
-    await app.stop()
     return res, em
 
 
-# Get all user groups
+# Yield groups of all accounts while paging through their dialogs
+# Groups without a known owner are assigned to the first account which is a member of them
+async def _scan_groups() -> AsyncIterator[dict]:
+    seen = set()
+    for app in await get_clients():
+        found = []
+        try:
+            # Get all user chats and keep groups and supergroups
+            async for item in scheduler.iterate(scheduler.READ, None, app.get_dialogs):
+                group = item.chat
+                if group.type != ChatType.SUPERGROUP and group.type != ChatType.GROUP:
+                    continue
+
+                found.append(group.id)
+                if group.id in seen:
+                    continue
+                seen.add(group.id)
+
+                yield {
+                    'id': group.id,
+                    'title': group.title,
+                    'description': group.description,
+                }
+        finally:
+            # Store owners once per account, also when the consumer stopped early
+            accounts.learn(found, app.name)
+
+
+# Get all user groups, concurrent callers share one scan
+@metrics.timed
+@helpers.single_flight
 async def get_all_groups() -> list:
-    # Get client instance
-    app = await get_client()
-
+    # Put all groups and supergroups in groups variable
+    groups = []
     try:
-        # Get all user chats
-        dialogs = app.get_dialogs()
+        async for group in _scan_groups():
+            groups.append(group)
     except (RPCError, PeerIdInvalid) as e:
         error(e)
-        await app.stop()
         return []
 
-    # Put all groups and supergroups in groups variable
-    groups = []
-    async for item in dialogs:
-        group = item.chat
-        if group.type == ChatType.SUPERGROUP or group.type == ChatType.GROUP:
-            groups.append({
-                'id': group.id,
-                'title': group.title,
-                'description': group.description,
-            })
-
-    # Stop client
-    await app.stop()
+    # Refresh groups index with scan result
+    directory.load(groups)
 
     return groups
 
 
+# Yield groups one by one for streaming responses
+# A stale index is rebuilt by the shared scan first, so concurrent streams start one dialogs scan only
+async def iter_groups() -> AsyncIterator[dict]:
+    groups, _, _ = await get_groups()
+    for group in groups:
+        yield group
+
+
+# Get groups from index, changed since given cursor if any
+# Returns groups, new cursor and whether groups is the full list
+@metrics.timed
+async def get_groups(since: Optional[str] = None) -> (list, str, bool):
+    # Build index with a full scan on first use and periodically to catch missed updates
+    if not directory.is_loaded(DIRECTORY_RESYNC_INTERVAL):
+        await get_all_groups()
+
+    groups, full = directory.changes(since)
+
+    return groups, directory.cursor(), full
+
+
+# Get contacts of the default account, concurrent callers share one fetch
+@metrics.timed
+@helpers.single_flight
 async def get_contacts() -> list:
     app = await get_client()
 
-    contacts = await app.get_contacts()
+    contacts = await scheduler.call(scheduler.READ, None, app.get_contacts)
+
+    return [contact_to_dict(item) for item in contacts]
+
+
+# Converts user object of a contact to dictionary
+def contact_to_dict(user: types.User) -> dict:
+    return {
+        'id': user.id,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'username': user.username,
+        'phone_number': user.phone_number,
+    }
+
+
+# Yield contacts one by one for streaming responses, an expired cache is refilled by the shared fetch
+async def iter_contacts() -> AsyncIterator[dict]:
+    contacts, _ = await get_cached_contacts()
+    for contact in contacts:
+        yield contact
 
-    await app.stop()
 
-    response = []
-    for item in contacts:
-        response.append({
-            'id': item.id,
-            'first_name': item.first_name,
-            'last_name': item.last_name,
-            'username': item.username,
-            'phone_number': item.phone_number,
-        })
+# Get contacts from cache, fetch them again if cache is expired or invalidated
+# Returns contacts and version of the list
+@metrics.timed
+async def get_cached_contacts() -> (list, str):
+    cached = contacts_cache.get()
+    if cached is not None:
+        return cached
 
-    return response
+    contacts = await get_contacts()
+    return contacts, contacts_cache.store(contacts)
+
+
+# Get contacts added, changed and removed since given version, None if version is unknown
+def get_contacts_delta(since: str) -> Optional[dict]:
+    return contacts_cache.delta(since)
 
 
 # Unarchive chat
-async def unarchive(chat_id: Union[str, int]) -> (bool, str):
+# Returns list of member ids whose permissions could not be changed as third value
+@metrics.timed
+async def unarchive(chat_id: Union[str, int], progress: Optional[Callable] = None) -> (bool, str, list):
     # Get client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
     # Unarchive chat using given chat id and return false on failure
     try:
-        await app.unarchive_chats([chat_id])
+        await scheduler.call(scheduler.ADMIN, chat_id, app.unarchive_chats, [chat_id])
     except (RPCError, PeerIdInvalid) as e:
         error(e)
-        await app.stop()
-        return False, e
+        return False, e, []
 
     # Grant send message permission to users
-    await change_all_chat_members_permissions(app, chat_id, True)
+    try:
+        _, failed = await change_all_chat_members_permissions(app, chat_id, True, progress=progress)
+    except (RPCError, PeerIdInvalid) as e:
+        error(e)
+        return False, e, []
 
-    # Stop client
-    await app.stop()
+    directory.set_archived(chat_id, False)
 
-    return True, ''
+    return True, '', failed
 
 
 # Get chat invite link
+# Primary link of the account is reused while it is valid, a new link is created only when there is none
+@metrics.timed
 async def get_invite_link(chat_id: Union[str, int]) -> str:
     # Get telegram client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
     # Get invite link and return empty on failure
     try:
-        link = await app.create_chat_invite_link(chat_id)
+        link = await _primary_invite_link(app, chat_id)
+        if link is None:
+            link = await scheduler.call(scheduler.ADMIN, chat_id, app.create_chat_invite_link, chat_id)
     except (RPCError, PeerIdInvalid) as e:
         error(e)
-        await app.stop()
         return ''
 
-    # Stop client and return link
-    await app.stop()
-
     return link.invite_link
 
 
+# Return primary invite link of the account if it is usable without limits, None otherwise
+async def _primary_invite_link(app: Client, chat_id: Union[str, int]) -> Optional[types.ChatInviteLink]:
+    me = await get_me(app)
+    links = scheduler.iterate(scheduler.READ, chat_id, app.get_chat_admin_invite_links, chat_id, me.id)
+    async for link in links:
+        if link.is_primary and not link.is_revoked and not link.expire_date and not link.member_limit:
+            return link
+
+    return None
+
+
 # Unban user from a group
+@metrics.timed
 async def unban_chat_member(chat_id: Union[str, int], user_id: Union[str, int]) -> (bool, str):
     # Get telegram client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
     # Unban user from group and return false on failure
     try:
-        await app.unban_chat_member(chat_id, user_id)
-    except (RPCError, PeerIdInvalid) as e:
+        user_id = await peers.resolve(app, user_id)
+        await scheduler.call(scheduler.MEMBERS, chat_id, app.unban_chat_member, chat_id, user_id)
+    except (RPCError, PeerIdInvalid, ValueError) as e:
         error(e)
-        await app.stop()
         return False, e
 
-    # Stop client
-    await app.stop()
-
     return True, ''
 
 
+# Get ids of groups which share a user with any account of the pool
+# Groups are learned as owned by the account which sees them, so later calls for them use that account
+async def get_common_groups(user_id: Union[str, int]) -> list:
+    chat_ids = []
+    for app in await get_clients():
+        found = []
+        try:
+            async for chat_id in _iter_common_groups(app, user_id):
+                found.append(chat_id)
+                if chat_id not in chat_ids:
+                    chat_ids.append(chat_id)
+        except (RPCError, ValueError) as e:
+            error(f'Failed to get common chats of {user_id} on {app.name}: {e}')
+        accounts.learn(found, app.name)
+
+    return chat_ids
+
+
+# Yield ids of groups an account shares with a user
+# Client.get_common_chats returns the first page only, so pages are requested with max_id until they run out
+async def _iter_common_groups(app: Client, user_id: Union[str, int]) -> AsyncIterator[int]:
+    resolved = await peers.resolve(app, user_id)
+    peer = await scheduler.call(scheduler.READ, None, app.resolve_peer, resolved)
+    if not isinstance(peer, raw.types.InputPeerUser):
+        raise ValueError(f'{user_id} is not a user')
+    user = raw.types.InputUser(user_id=peer.user_id, access_hash=peer.access_hash)
+
+    max_id = 0
+    while True:
+        result = await scheduler.call(
+            scheduler.READ, None, app.invoke,
+            raw.functions.messages.GetCommonChats(user_id=user, max_id=max_id, limit=COMMON_CHATS_LIMIT)
+        )
+
+        for chat in result.chats:
+            if isinstance(chat, raw.types.Channel) and chat.megagroup:
+                yield utils.get_channel_id(chat.id)
+            elif isinstance(chat, raw.types.Chat) and not chat.deactivated:
+                yield -chat.id
+
+        if len(result.chats) < COMMON_CHATS_LIMIT:
+            return
+        max_id = min(chat.id for chat in result.chats)
+
+
+# Ban user from every group it shares with the pool, or from every indexed group if everywhere is set
+# Yields result of every group as soon as it is done
+async def ban_everywhere(user_id: Union[str, int], everywhere: bool = False) -> AsyncIterator[dict]:
+    chat_ids = await _member_fan_out_groups(user_id, everywhere)
+    async for result in _member_fan_out(ban_chat_member, chat_ids, user_id):
+        yield result
+
+
+# Unban user in every indexed group, which includes groups the user has already been removed from
+# Yields result of every group as soon as it is done
+async def unban_everywhere(user_id: Union[str, int]) -> AsyncIterator[dict]:
+    chat_ids = await _member_fan_out_groups(user_id, True)
+    async for result in _member_fan_out(unban_chat_member, chat_ids, user_id):
+        yield result
+
+
+# Find groups of a cross group call
+# Common groups resolve the user on every account already, for indexed groups it is resolved here,
+# so concurrent calls of the fan out find it in peer cache instead of resolving it once per group
+async def _member_fan_out_groups(user_id: Union[str, int], everywhere: bool) -> list:
+    if not everywhere:
+        return await get_common_groups(user_id)
+
+    for app in await get_clients():
+        try:
+            await peers.resolve(app, user_id)
+        except (RPCError, ValueError) as e:
+            error(f'Failed to resolve {user_id} on {app.name}: {e}')
+
+    groups, _, _ = await get_groups()
+    return [group['id'] for group in groups]
+
+
+# Run a member call on every chat with bounded concurrency and yield results in completion order
+async def _member_fan_out(func: Callable, chat_ids: list, user_id: Union[str, int]) -> AsyncIterator[dict]:
+    semaphore = asyncio.Semaphore(MEMBERS_FAN_OUT_CONCURRENCY)
+
+    async def run(chat_id: Union[str, int]) -> dict:
+        async with semaphore:
+            res, em = await func(chat_id, user_id)
+        return {'chat_id': chat_id, 'ok': bool(res), 'error': str(em)}
+
+    tasks = [asyncio.ensure_future(run(chat_id)) for chat_id in chat_ids]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # Stop remaining calls if the consumer went away
+        for task in tasks:
+            task.cancel()
+
+
 # Promote member to admin
-async def promote_member(chat_id: Union[str, int], user_id: Union[str, int]) -> bool:
+@metrics.timed
+async def promote_member(chat_id: Union[str, int], user_id: Union[str, int], privileges_profile: str = 'admin') -> bool:
+    results = await promote_members(chat_id, [user_id], privileges_profile)
+
+    return results[user_id]
+
+
+# Promote members to admin concurrently with privileges of a named profile
+# Returns user id -> true if promoted and false on failure
+@metrics.timed
+async def promote_members(chat_id: Union[str, int], user_ids: list, privileges_profile: str = 'admin') -> dict:
     # Get telegram client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
-    # Promote member to admin and return false on failure
-    try:
-        result = await app.promote_chat_member(chat_id=chat_id, user_id=user_id, privileges=types.ChatPrivileges(
-            can_delete_messages=True,
-            can_restrict_members=True,
-            can_promote_members=True,
-            can_invite_users=True,
-            can_manage_chat=True,
-            can_manage_video_chats=True,
-            can_change_info=True,
-            can_pin_messages=True,
-            can_edit_messages=True,
-            can_post_messages=True,
-        ))
-    except (RPCError, PeerIdInvalid) as e:
-        error(e)
-        await app.stop()
-        return False
+    privileges = PRIVILEGE_PROFILES[privileges_profile]
+
+    async def promote(user_id: Union[str, int]) -> bool:
+        # Promote member to admin and return false on failure
+        try:
+            user_id = await peers.resolve(app, user_id)
+            return await scheduler.call(
+                scheduler.ADMIN, chat_id, app.promote_chat_member,
+                chat_id=chat_id, user_id=user_id, privileges=privileges
+            )
+        # Resolving raises ValueError for peers which are not users, the rest are telegram errors
+        except (RPCError, ValueError) as e:
+            error(f'Failed to promote {user_id} in chat {chat_id}: {e}')
+            return False
+
+    results = await _bounded_gather(promote, user_ids, PROMOTE_CONCURRENCY)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    return {user_id: result is True for user_id, result in zip(user_ids, results)}
+
+
+# Resolve usernames to user ids in one concurrent batch and cache them for later calls
+# Returns username -> user id, usernames which could not be resolved are left out
+# Access hashes are per account, so usernames are resolved by the account which owns chat_id
+@metrics.timed
+async def resolve_users(user_ids: list, chat_id: Optional[Union[str, int]] = None) -> dict:
+    # Get telegram client instance
+    app = await get_client(chat_id)
 
-    # Stop client
-    await app.stop()
+    results = await peers.resolve_many(app, user_ids)
+    for user_id, result in results.items():
+        if isinstance(result, Exception):
+            error(f'Failed to resolve {user_id}: {result}')
 
-    return result
+    return {user_id: result for user_id, result in results.items() if not isinstance(result, Exception)}
 
 
 # edit message with given message id and chat id
+@metrics.timed
 async def edit_message(message_id: int, chat_id: Union[str, int], message: str) -> (bool, str):
     # Get telegram client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
     # Edit message and return false on failure
     try:
-        await app.edit_message_text(message_id=message_id, chat_id=chat_id, text=message)
+        await scheduler.call(
+            scheduler.MESSAGES, chat_id, app.edit_message_text, message_id=message_id, chat_id=chat_id, text=message
+        )
     except (RPCError, PeerIdInvalid) as e:
         error(e)
-        await app.stop()
         return False, e
 
-    # Stop client instance
-    await app.stop()
-
     return True, ''
 
 
 # delete message with given message id and chat id
+@metrics.timed
 async def delete_message(message_id: int, chat_id: Union[str, int]) -> (bool, str):
     # Get telegram client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
     # Delete message and return false on failure
     try:
-        await app.delete_messages(chat_id=chat_id, message_ids=message_id)
+        await scheduler.call(scheduler.MESSAGES, chat_id, app.delete_messages, chat_id=chat_id, message_ids=message_id)
     except (RPCError, PeerIdInvalid) as e:
         error(e)
-        await app.stop()
         return False, e
 
-    # Stop client
-    await app.stop()
-
     return True, ''
 
 
-# Change chat permissions in telegram app
-async def change_all_chat_members_permissions(client: Client, chat_id: str, can_send_message: bool = False) -> bool:
-    # Get all chat members
-    members = client.get_chat_members(chat_id)
+# Delete messages of a chat, up to DELETE_MESSAGES_LIMIT ids in every call
+# Returns result and error of every message in given order, a failed call only fails messages of its chunk
+@metrics.timed
+async def delete_messages(chat_id: Union[str, int], message_ids: list) -> list:
+    # Get telegram client instance
+    app = await get_client(chat_id)
 
-    # Change permissions for each member
-    async for member in members:
-        # Skip if member is admin or owner or in exceptions
-        if member.status == ChatMemberStatus.ADMINISTRATOR \
-                or member.status == ChatMemberStatus.OWNER:
-            continue
+    results = []
+    for index in range(0, len(message_ids), DELETE_MESSAGES_LIMIT):
+        chunk = message_ids[index:index + DELETE_MESSAGES_LIMIT]
+
+        # Delete chunk and mark its messages as failed on error
         try:
-            await client.restrict_chat_member(
-                chat_id=chat_id,
-                user_id=member.user.id,
-                permissions=types.ChatPermissions(
-                    can_send_messages=can_send_message,
-                    can_send_media_messages=can_send_message,
-                    can_add_web_page_previews=can_send_message,
-                )
-            )
+            await scheduler.call(scheduler.MESSAGES, chat_id, app.delete_messages, chat_id=chat_id, message_ids=chunk)
         except (RPCError, PeerIdInvalid) as e:
             error(e)
-            error(f'Failed to change permissions for {member.user.id} in chat {chat_id}')
-            return False
+            results.extend([(False, e)] * len(chunk))
+            continue
 
-    return True
+        results.extend([(True, '')] * len(chunk))
+
+    return results
+
+
+# Edit many messages given as (chat_id, message_id, text) with bounded concurrency
+# Returns result and error of every message in given order
+@metrics.timed
+async def edit_messages(messages: list) -> list:
+    async def edit(item: tuple) -> (bool, str):
+        chat_id, message_id, text = item
+        return await edit_message(message_id, chat_id, text)
+
+    results = await _bounded_gather(edit, messages, MESSAGES_BULK_CONCURRENCY)
+    for result in results:
+        # edit_message handles telegram errors, anything else is a bug
+        if isinstance(result, Exception):
+            raise result
+
+    return results
+
+
+# Delete many messages given as (chat_id, message_id)
+# Messages are grouped per chat, every chat is cleaned up with bulk deletes and chats run concurrently
+# Returns result and error of every message in given order
+@metrics.timed
+async def delete_messages_bulk(messages: list) -> list:
+    # chat id -> positions of its messages in given list
+    chats = {}
+    for position, (chat_id, _) in enumerate(messages):
+        chats.setdefault(chat_id, []).append(position)
+
+    async def delete(chat_id: Union[str, int]) -> list:
+        return await delete_messages(chat_id, [messages[position][1] for position in chats[chat_id]])
+
+    results = [None] * len(messages)
+    for chat_id, chat_results in zip(chats, await _bounded_gather(delete, list(chats), MESSAGES_BULK_CONCURRENCY)):
+        # delete_messages handles telegram errors, anything else is a bug
+        if isinstance(chat_results, Exception):
+            raise chat_results
+        for position, result in zip(chats[chat_id], chat_results):
+            results[position] = result
 
+    return results
 
-async def revoke_chat_invite_links(chat_id: Union[int, str]):
+
+# Run coroutine function for each item with at most limit calls running at once
+# Returns results or raised exceptions in order of items
+async def _bounded_gather(func, items: list, limit: int) -> list:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+
+# Change chat permissions in telegram app
+# Reports members_total and members_done to progress callback if given
+# Returns true if all members changed and list of member ids which failed
+@metrics.timed
+async def change_all_chat_members_permissions(client: Client, chat_id: Union[str, int], can_send_message: bool = False,
+                                              chat_wide: Optional[bool] = None,
+                                              progress: Optional[Callable] = None) -> (bool, list):
+    if chat_wide is None:
+        chat_wide = CHAT_WIDE_PERMISSIONS
+
+    # One call changes default permissions of every non admin member.
+    # Per member restrictions set before are not lifted by this, so stick to one mode per group.
+    if chat_wide:
+        permissions = DEFAULT_CHAT_PERMISSIONS if can_send_message else ARCHIVED_CHAT_PERMISSIONS
+        await scheduler.call(scheduler.ADMIN, chat_id, client.set_chat_permissions, chat_id, permissions)
+        return True, []
+
+    # Get all chat members, skip if member is admin or owner
+    user_ids = []
+    async for member in scheduler.iterate(scheduler.READ, chat_id, client.get_chat_members, chat_id):
+        if member.status == ChatMemberStatus.ADMINISTRATOR \
+                or member.status == ChatMemberStatus.OWNER:
+            continue
+        user_ids.append(member.user.id)
+
+    done = 0
+    if progress:
+        progress(members_total=len(user_ids), members_done=done)
+
+    permissions = types.ChatPermissions(
+        can_send_messages=can_send_message,
+        can_send_media_messages=can_send_message,
+        can_add_web_page_previews=can_send_message,
+    )
+
+    async def restrict(user_id: int):
+        nonlocal done
+        try:
+            for attempt in range(PERMISSIONS_RETRIES + 1):
+                try:
+                    return await scheduler.call(
+                        scheduler.MEMBERS, chat_id, client.restrict_chat_member,
+                        chat_id=chat_id, user_id=user_id, permissions=permissions
+                    )
+                except _TRANSIENT_ERRORS as e:
+                    error(f'Failed to change permissions for {user_id} in chat {chat_id} (attempt {attempt + 1}): {e}')
+                    if attempt == PERMISSIONS_RETRIES:
+                        raise
+        finally:
+            done += 1
+            if progress:
+                progress(members_done=done)
+
+    # Change permissions of members concurrently and collect the ones which failed
+    results = await _bounded_gather(restrict, user_ids, PERMISSIONS_CONCURRENCY)
+    failed = []
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, (RPCError, PeerIdInvalid) + _TRANSIENT_ERRORS):
+            error(f'Failed to change permissions for {user_id} in chat {chat_id}: {result}')
+            failed.append(user_id)
+        elif isinstance(result, Exception):
+            # Bugs are not member failures, let the caller fail loudly
+            raise result
+    if failed:
+        error(f'Failed to change permissions for {len(failed)} of {len(user_ids)} members in chat {chat_id}')
+
+    return not failed, failed
+
+
+# Revoke all active invite links of the account in a chat concurrently
+# Revoked links are deleted afterwards if delete_revoked is set, defaults to DELETE_REVOKED_INVITE_LINKS
+@metrics.timed
+async def revoke_chat_invite_links(chat_id: Union[int, str], delete_revoked: Optional[bool] = None):
     # Get client instance
-    app = await get_client()
+    app = await get_client(chat_id)
 
-    # Get bot chat id
-    me = await app.get_me()
+    # Get account user, links are listed per admin
+    me = await get_me(app)
 
     # Get all chat invite links
-    links = app.get_chat_admin_invite_links(chat_id, me.id)
-    async for link in links:
-        if not link.is_revoked:
-            try:
-                await app.revoke_chat_invite_link(chat_id, link.invite_link)
-            except (RPCError, PeerIdInvalid) as e:
-                error(e)
+    links = scheduler.iterate(scheduler.READ, chat_id, app.get_chat_admin_invite_links, chat_id, me.id)
+    active = [link.invite_link async for link in links if not link.is_revoked]
+
+    async def revoke(invite_link: str):
+        return await scheduler.call(scheduler.ADMIN, chat_id, app.revoke_chat_invite_link, chat_id, invite_link)
 
-    # Stop client
-    await app.stop()
+    for result in await _bounded_gather(revoke, active, REVOKE_CONCURRENCY):
+        if isinstance(result, Exception):
+            error(result)
+
+    if delete_revoked is None:
+        delete_revoked = DELETE_REVOKED_INVITE_LINKS
+    if not delete_revoked:
+        return
+
+    # Delete all revoked links of the account with one call
+    try:
+        await scheduler.call(scheduler.ADMIN, chat_id, app.delete_chat_admin_invite_links, chat_id, me.id)
+    except (RPCError, PeerIdInvalid) as e:
+        error(e)